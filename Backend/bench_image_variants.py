@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+import uuid
+import resource
+import argparse
+import tempfile
+import subprocess
+from PIL import Image
+from imaging import IMAGE_VARIANTS, render_image_variants
+
+# Compares the old thumbnail path with render_image_variants on the same image.
+# Every mode runs in its own process so peak RSS is not shared between them.
+# Nothing is uploaded, this only measures the Pillow work.
+#
+#   python bench_image_variants.py photo.jpg --runs 20
+#   python bench_image_variants.py --synthetic 6000x4000
+
+def old_thumbnail(image_path: str, size, directory: str) -> str:
+    # What create_thumbnail did before: a fresh decode for every size, written to disk
+    img = Image.open(image_path)
+    if img.mode in ("RGBA", "P"):
+        img = img.convert("RGB")
+
+    img.thumbnail(size)
+    thumb_path = os.path.join(directory, f"{uuid.uuid4().hex}.jpg")
+    img.save(thumb_path, format="JPEG")
+    return thumb_path
+
+def run_before(image_path: str, variants: dict, directory: str):
+    for size in variants.values():
+        os.remove(old_thumbnail(image_path, size, directory))
+
+def run_after(image_path: str, variants: dict, directory: str):
+    render_image_variants(image_path, variants)
+
+MODES = {
+    "before": run_before,
+    "after": run_after,
+}
+
+def worker(mode: str, image_path: str, runs: int, variants: dict):
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with tempfile.TemporaryDirectory() as directory:
+        MODES[mode](image_path, variants, directory)
+
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            MODES[mode](image_path, variants, directory)
+            timings.append(time.perf_counter() - started)
+
+    timings.sort()
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        "mode": mode,
+        "median_ms": timings[len(timings) // 2] * 1000,
+        "min_ms": timings[0] * 1000,
+        "peak_rss_mb": peak_kb / 1024,
+        "added_rss_mb": (peak_kb - baseline_kb) / 1024,
+    }))
+
+def make_synthetic(size: str) -> str:
+    width, height = (int(side) for side in size.lower().split("x"))
+    # Noise keeps the JPEG close to a real photo in size and decode cost
+    bands = [Image.effect_noise((width, height), sigma).convert("L") for sigma in (40, 60, 80)]
+    path = os.path.join(tempfile.gettempdir(), f"bench_{width}x{height}.jpg")
+    Image.merge("RGB", bands).save(path, format="JPEG", quality=90)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thumbnail generation before and after render_image_variants")
+    parser.add_argument("path", nargs="?")
+    parser.add_argument("--synthetic", help="Generate a WIDTHxHEIGHT noise JPEG instead of reading path")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--grid-only", action="store_true", help="Only the 150x150 grid size, what portfolio ingest makes")
+    parser.add_argument("--worker", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--make", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    variants = {"grid": IMAGE_VARIANTS["grid"]} if args.grid_only else IMAGE_VARIANTS
+    if args.worker:
+        worker(args.worker, args.path, args.runs, variants)
+        return
+    if args.make:
+        print(make_synthetic(args.make))
+        return
+
+    if args.synthetic:
+        # ru_maxrss survives exec, so the big noise image is built in its own
+        # process rather than raising the starting peak of every worker
+        image_path = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--make", args.synthetic], text=True).strip()
+    elif args.path:
+        image_path = args.path
+    else:
+        sys.exit("Pass an image path or --synthetic WIDTHxHEIGHT")
+
+    with Image.open(image_path) as img:
+        print(f"{image_path}: {img.size[0]}x{img.size[1]} {img.format}, {os.path.getsize(image_path) / (1024 * 1024):.1f} MB")
+    print(f"Variants: {', '.join(f'{name} {size[0]}x{size[1]}' for name, size in variants.items())}, {args.runs} runs")
+
+    command = [sys.executable, os.path.abspath(__file__), image_path, "--runs", str(args.runs), "--worker"]
+    extra = ["--grid-only"] if args.grid_only else []
+    results = [json.loads(subprocess.check_output(command + [mode] + extra)) for mode in MODES]
+
+    for result in results:
+        print(f"{result['mode']:>6}: median {result['median_ms']:.1f}ms, min {result['min_ms']:.1f}ms, peak RSS {result['peak_rss_mb']:.0f} MB (+{result['added_rss_mb']:.0f} MB over startup)")
+    before, after = results
+    print(f"Speedup: {before['median_ms'] / after['median_ms']:.1f}x")
+
+if __name__ == "__main__":
+    main()
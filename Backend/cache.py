@@ -0,0 +1,138 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from fastapi.encoders import jsonable_encoder
+
+# Caches live in the worker process, so each uvicorn worker keeps its own copy
+# and only sees invalidations from writes it handled itself.
+CACHE_REGISTRY = {}
+
+Snapshot = namedtuple("Snapshot", ["data", "body", "etag"])
+
+def build_snapshot(data) -> Snapshot:
+    body = json.dumps(jsonable_encoder(data), separators=(",", ":")).encode()
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    return Snapshot(data=data, body=body, etag=etag)
+
+class SnapshotCache:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        CACHE_REGISTRY[name] = self
+
+    def get(self, loader) -> Snapshot:
+        with self._lock:
+            if self._snapshot is not None:
+                self.hits += 1
+                return self._snapshot
+            self.misses += 1
+            version = self._version
+
+        # Rendered once per write, so requests only copy bytes onto the socket
+        snapshot = build_snapshot(loader())
+
+        with self._lock:
+            # A write that landed while we were loading makes this result stale
+            if version == self._version:
+                self._snapshot = snapshot
+        return snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._version += 1
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "cached": self._snapshot is not None,
+                "bytes": len(self._snapshot.body) if self._snapshot else 0,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+class LRUCache:
+    def __init__(self, name: str, maxsize: int = 256):
+        self.name = name
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        CACHE_REGISTRY[name] = self
+
+    def get(self, key, loader):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            version = self._version
+
+        value = loader()
+
+        # Misses are not cached, so a newly added entry shows up straight away
+        if value is None:
+            return None
+
+        with self._lock:
+            if version == self._version:
+                self._data[key] = value
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+            self._version += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+catalog_cache = SnapshotCache("catalog")
+product_slug_cache = LRUCache("product_by_slug", maxsize=int(os.getenv("PRODUCT_CACHE_SIZE", 512)))
+
+portfolio_cache = SnapshotCache("portfolios")
+portfolio_category_cache = LRUCache("portfolios_by_category", maxsize=int(os.getenv("PORTFOLIO_CATEGORY_CACHE_SIZE", 64)))
+pic_of_week_cache = SnapshotCache("pics_of_the_week")
+current_pic_of_week_cache = SnapshotCache("current_pic_of_the_week")
+
+def invalidate_products(slug: str = None):
+    catalog_cache.invalidate()
+    product_slug_cache.invalidate(slug)
+
+def invalidate_portfolios():
+    portfolio_cache.invalidate()
+    portfolio_category_cache.invalidate()
+
+def invalidate_pics_of_week():
+    pic_of_week_cache.invalidate()
+    current_pic_of_week_cache.invalidate()
+
+def cache_stats() -> dict:
+    return {name: cache.stats() for name, cache in CACHE_REGISTRY.items()}
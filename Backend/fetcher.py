@@ -0,0 +1,116 @@
+import time
+import threading
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cache import CACHE_REGISTRY
+
+class FetchError(Exception):
+    pass
+
+class FetchTooLarge(FetchError):
+    pass
+
+class RemoteFetcher:
+    def __init__(self, name: str, max_bytes: int, connect_timeout: float = 5, read_timeout: float = 30,
+                 pool_size: int = 10, cache_seconds: int = 300, cache_max_bytes: int = 64 * 1024 * 1024,
+                 chunk_size: int = 1024 * 1024):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.timeout = (connect_timeout, read_timeout)
+        self.chunk_size = chunk_size
+        self.cache_seconds = cache_seconds
+        self.cache_max_bytes = cache_max_bytes
+
+        # One keep-alive pool per host, shared by every worker thread
+        retries = Retry(total=2, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=("GET",))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.downloaded_bytes = 0
+        CACHE_REGISTRY[name] = self
+
+    def iter_chunks(self, url: str):
+        url = str(url)
+        body = self._cached(url)
+        if body is not None:
+            yield body
+            return
+
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+
+                content_length = response.headers.get("Content-Length")
+                if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+                    raise FetchTooLarge(f"{url} is larger than {self.max_bytes} bytes")
+
+                # Small bodies are kept for a while so a retry or a duplicate import
+                # does not download them again
+                keep = bytearray()
+                size = 0
+                for chunk in response.iter_content(self.chunk_size):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise FetchTooLarge(f"{url} is larger than {self.max_bytes} bytes")
+                    if keep is not None and size <= self.cache_max_bytes // 4:
+                        keep.extend(chunk)
+                    else:
+                        keep = None
+                    yield chunk
+        except requests.RequestException as e:
+            raise FetchError(str(e)) from e
+
+        with self._lock:
+            self.downloaded_bytes += size
+        if keep is not None:
+            self._store(url, bytes(keep))
+
+    def fetch(self, url: str) -> bytes:
+        return b"".join(self.iter_chunks(url))
+
+    def _cached(self, url: str):
+        with self._lock:
+            entry = self._cache.get(url)
+            if entry and entry[0] > time.monotonic():
+                self._cache.move_to_end(url)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                self._drop(url)
+            self.misses += 1
+            return None
+
+    def _store(self, url: str, body: bytes):
+        if not self.cache_seconds:
+            return
+
+        with self._lock:
+            if url in self._cache:
+                self._drop(url)
+            self._cache[url] = (time.monotonic() + self.cache_seconds, body)
+            self._cached_bytes += len(body)
+            while self._cached_bytes > self.cache_max_bytes:
+                self._drop(next(iter(self._cache)))
+
+    def _drop(self, url: str):
+        _, body = self._cache.pop(url)
+        self._cached_bytes -= len(body)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._cache),
+                "bytes": self._cached_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "downloaded_bytes": self.downloaded_bytes,
+            }
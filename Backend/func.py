@@ -3,23 +3,33 @@ import os
 from fastapi import UploadFile
 import uuid
 from PIL import Image
-import requests
 import io
+import base64
+import hashlib
 from decimal import Decimal
 from datetime import datetime
+from urllib.parse import urlparse
 import resend
 import uuid
 import logging
-import cloudinary
-import cloudinary.uploader
-import time
-from fastapi import HTTPException
+import asyncio
+from functools import partial
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
-from tables import Orders, OrderItem, Shipping, CheckoutInfo, ShippingInfo, Products, Portfolio, PortfolioImages
+from tables import Local_Session, Orders, OrderItem, Shipping, CheckoutInfo, ShippingInfo, Products, Portfolio, PortfolioImages, MediaAssets
 from schemas import DimensionType, DIMENSION_DETAILS, ProductType
 from dotenv import load_dotenv
-from sqlalchemy import text
+from sqlalchemy import text, update, delete, case, event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from passlib.context import CryptContext
+from scratch import ScratchStorage
+from fetcher import RemoteFetcher, FetchError, FetchTooLarge
+from storage import build_media_storage
+from imaging import render_image_variants, IMAGE_VARIANTS
 
 load_dotenv()
                    
@@ -48,117 +58,448 @@ UPLOAD_DIR = "uploads"
 THUMBNAIL_DIR = "thumbnails"
 POEM_DIR = "pics_of_the_week"
 
-cloudinary.config(
-    cloud_name="uiaphotography",
-    api_key=os.getenv("CLOUDINARY_API_KEY"),
-    api_secret=os.getenv("CLOUDINARY_API_SECRET"),
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 4))
+PORTFOLIO_UPLOAD_CONCURRENCY = int(os.getenv("PORTFOLIO_UPLOAD_CONCURRENCY", 4))
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", 250))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+SCRATCH_MAX_MB = int(os.getenv("SCRATCH_MAX_MB", 1024))
+SCRATCH_MAX_AGE_HOURS = int(os.getenv("SCRATCH_MAX_AGE_HOURS", 24))
+SCRATCH_KEEP_ORIGINALS = os.getenv("SCRATCH_KEEP_ORIGINALS", "false").lower() == "true"
+MEDIA_DELETE_BATCH_SIZE = int(os.getenv("MEDIA_DELETE_BATCH_SIZE", 100))
+MEDIA_DELETE_CONCURRENCY = int(os.getenv("MEDIA_DELETE_CONCURRENCY", 4))
+FETCH_TIMEOUT_SECONDS = int(os.getenv("FETCH_TIMEOUT_SECONDS", 30))
+FETCH_CACHE_SECONDS = int(os.getenv("FETCH_CACHE_SECONDS", 300))
+FETCH_CACHE_MB = int(os.getenv("FETCH_CACHE_MB", 64))
+
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", 50))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 200))
+
+def parse_fields(fields: str, model) -> list:
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    columns = model.__table__.columns
+    unknown = [field for field in requested if field not in columns or columns[field].info.get("internal")]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+
+    # The cursor is taken from the id column, so it is always selected
+    if "id" not in requested:
+        requested.insert(0, "id")
+    return requested
+
+def keyset_page(query, id_column, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE):
+    if cursor is not None:
+        query = query.filter(id_column > cursor)
+
+    rows = query.order_by(id_column).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return rows, next_cursor
+
+def fetch_table_page(db: Session, model, cursor: int = None, limit: int = None, fields: str = None, filters: list = None, options: list = None):
+    if fields:
+        query = db.query(*[getattr(model, name) for name in parse_fields(fields, model)])
+    else:
+        query = db.query(model).options(*(options or []))
+    if filters:
+        query = query.filter(*filters)
+
+    if cursor is None and limit is None:
+        return query.order_by(model.id).all(), None
+    return keyset_page(query, model.id, cursor, limit or DEFAULT_PAGE_SIZE)
+
+def page_response(rows, next_cursor, response: Response, fields: str = None):
+    headers = {"X-Next-Cursor": str(next_cursor)} if next_cursor is not None else {}
+    if fields:
+        return JSONResponse(content=jsonable_encoder([dict(row._mapping) for row in rows]), headers=headers)
+
+    response.headers.update(headers)
+    return rows
+
+def build_prefix_tsquery(search: str):
+    terms = re.findall(r"\w+", search.lower())
+    if not terms:
+        return None
+    return " & ".join(f"{term}:*" for term in terms)
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{row_id}".encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(row_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def snapshot_response(request: Request, snapshot, headers: dict = None) -> Response:
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache", **(headers or {})}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match == "*" or snapshot.etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
+# MEDIA_STORAGE=local keeps every upload on disk and serves it from /media,
+# so the ingest pipeline can run without Cloudinary
+MEDIA_STORAGE = os.getenv("MEDIA_STORAGE", "cloudinary")
+media_storage = build_media_storage(MEDIA_STORAGE)
+
+scratch_storage = ScratchStorage(
+    [UPLOAD_DIR, THUMBNAIL_DIR, POEM_DIR],
+    max_bytes=SCRATCH_MAX_MB * 1024 * 1024,
+    max_age_seconds=SCRATCH_MAX_AGE_HOURS * 3600,
+    keep_originals=SCRATCH_KEEP_ORIGINALS,
+)
+
+remote_fetcher = RemoteFetcher(
+    "remote_images",
+    max_bytes=MAX_UPLOAD_MB * 1024 * 1024,
+    read_timeout=FETCH_TIMEOUT_SECONDS,
+    pool_size=IMAGE_WORKERS,
+    cache_seconds=FETCH_CACHE_SECONDS,
+    cache_max_bytes=FETCH_CACHE_MB * 1024 * 1024,
+    chunk_size=UPLOAD_CHUNK_SIZE,
 )
 
-def save_upload_file(upload_file: UploadFile) -> str:
-    if not os.path.exists(UPLOAD_DIR):
-        os.makedirs(UPLOAD_DIR)
+# Pillow and Cloudinary calls block, so handlers hand them to this pool instead
+# of running them on the event loop. The pool size caps concurrent uploads.
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+async def run_image_task(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(image_executor, partial(fn, *args, **kwargs))
+
+def stage_chunks(chunks, directory: str = UPLOAD_DIR, ext: str = ".jpg") -> dict:
+    os.makedirs(directory, exist_ok=True)
 
-    ext = os.path.splitext(upload_file.filename)[1] or ".jpg"
     unique_filename = f"{uuid.uuid4().hex}{ext}"
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
-
-    with open(file_path, "wb") as out_file:
-        content = upload_file.file.read()
-        out_file.write(content)
-
-    upload_result = cloudinary.uploader.upload(
-        file_path,
-        folder="uploads",
-        public_id=unique_filename.split(".")[0],
-        resource_type="image",
-        overwrite=True,
-    )
+    file_path = os.path.join(directory, unique_filename)
+
+    max_bytes = MAX_UPLOAD_MB * 1024 * 1024
+    digest = hashlib.sha256()
+    size_bytes = 0
 
+    try:
+        with open(file_path, "wb") as out_file:
+            for chunk in chunks:
+                size_bytes += len(chunk)
+                if size_bytes > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"File exceeds the {MAX_UPLOAD_MB} MB upload limit")
+                digest.update(chunk)
+                out_file.write(chunk)
+    except Exception:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+
+    # Pinned until the caller releases it once the upload has been stored
+    scratch_storage.register(file_path, size_bytes)
     return {
         "local_path": file_path,
-        "cloudinary_url": upload_result["secure_url"],
+        "size_bytes": size_bytes,
+        "sha256": digest.hexdigest(),
     }
 
-def create_thumbnail(image_path: str = None, image_url: str = None, size=(150, 150), folder: str = "thumbnails") -> dict:
-    if not os.path.exists(THUMBNAIL_DIR):
-        os.makedirs(THUMBNAIL_DIR)
+def stage_upload(upload_file: UploadFile, directory: str = UPLOAD_DIR) -> dict:
+    ext = os.path.splitext(upload_file.filename or "")[1] or ".jpg"
+    return stage_chunks(iter(lambda: upload_file.file.read(UPLOAD_CHUNK_SIZE), b""), directory, ext)
+
+def fetch_remote_image(image_url: str) -> bytes:
+    try:
+        return remote_fetcher.fetch(image_url)
+    except FetchTooLarge:
+        raise HTTPException(status_code=413, detail=f"File exceeds the {MAX_UPLOAD_MB} MB upload limit")
+    except FetchError as e:
+        raise HTTPException(status_code=400, detail=f"Could not download image: {e}")
+
+def stage_url(image_url: str, directory: str = UPLOAD_DIR) -> dict:
+    ext = os.path.splitext(urlparse(str(image_url)).path)[1] or ".jpg"
+    try:
+        return stage_chunks(remote_fetcher.iter_chunks(image_url), directory, ext)
+    except FetchTooLarge:
+        raise HTTPException(status_code=413, detail=f"File exceeds the {MAX_UPLOAD_MB} MB upload limit")
+    except FetchError as e:
+        raise HTTPException(status_code=400, detail=f"Could not download image: {e}")
+
+def upload_original(local_path: str, folder: str = "uploads", public_id: str = None) -> str:
+    return media_storage.upload(local_path, folder, public_id)
 
+def generate_image_variants(image_path: str = None, image_url: str = None, variants: dict = None, folder: str = "thumbnails") -> dict:
     if image_path:
-        img = Image.open(image_path)
+        source = image_path
     elif image_url:
-        import requests, io
-        response = requests.get(str(image_url))
-        img = Image.open(io.BytesIO(response.content))
+        source = io.BytesIO(fetch_remote_image(image_url))
     else:
         raise ValueError("Provide either image_path or image_url")
-    
-    if img.mode in ("RGBA", "P"):
-        img = img.convert("RGB")
-
-    img.thumbnail(size)
-    thumb_filename = f"{uuid.uuid4().hex}.jpg"
-    thumb_path = os.path.join(THUMBNAIL_DIR, thumb_filename)
-    img.save(thumb_path, format="JPEG")
-
-    upload_thumb = cloudinary.uploader.upload(
-        thumb_path,
-        folder=folder,
-        public_id=thumb_filename.split(".")[0],
-        resource_type="image",
-        overwrite=True,
-    )
 
+    base_id = uuid.uuid4().hex
     return {
-        "local_thumbnail": thumb_path,
-        "cloudinary_thumbnail_url": upload_thumb["secure_url"],
+        name: media_storage.upload(buffer, folder, f"{base_id}_{name}")
+        for name, buffer in render_image_variants(source, variants).items()
     }
 
-def handle_image_upload(upload_file: UploadFile) -> dict:
-    image_info = save_upload_file(upload_file)
-    thumbnail_info = create_thumbnail(image_info["local_path"])
+def create_thumbnail(image_path: str = None, image_url: str = None, size=(150, 150), folder: str = "thumbnails", variants: dict = None) -> dict:
+    variant_urls = generate_image_variants(image_path=image_path, image_url=image_url, variants={"grid": size, **(variants or {})}, folder=folder)
 
     return {
-        "image_url": image_info["cloudinary_url"],
-        "thumbnail_url": thumbnail_info["cloudinary_thumbnail_url"],
+        "cloudinary_thumbnail_url": variant_urls["grid"],
+        "variants": variant_urls,
     }
 
+# EXIF orientations 5-8 store the image rotated by 90 degrees
+EXIF_ORIENTATION_TAG = 0x0112
+ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+# Formats whose EXIF block is parsed with the header. PNG keeps it in chunks
+# that getexif() can only reach by loading every pixel, so it is skipped.
+HEADER_EXIF_FORMATS = {"JPEG", "MPO", "TIFF", "WEBP"}
+
+def read_image_metadata(staged_file: dict) -> dict:
+    metadata = {
+        "resolution": None,
+        "file_size_mb": round(staged_file["size_bytes"] / (1024 * 1024), 2),
+        "file_format": None,
+    }
+    try:
+        # Image.open only parses the header, the pixel data is never decoded here
+        with Image.open(staged_file["local_path"]) as img:
+            width, height = img.size
+            if img.format in HEADER_EXIF_FORMATS and img.getexif().get(EXIF_ORIENTATION_TAG) in ROTATED_ORIENTATIONS:
+                width, height = height, width
+            metadata["resolution"] = f"{width}x{height}"
+            metadata["file_format"] = img.format
+    except Exception as e:
+        logger.warning(f"Could not read image metadata from {staged_file['local_path']}: {e}")
+    return metadata
+
+# Asset rows are claimed and counted in their own short transactions, run on
+# the image pool, so no request holds a row lock across its awaits. The
+# caller's session remembers each claim and gives it back if it never commits.
+def claim_media_asset(staged_file: dict, kind: str):
+    session = Local_Session()
+    try:
+        asset = session.execute(
+            update(MediaAssets)
+            .where(MediaAssets.sha256 == staged_file["sha256"], MediaAssets.kind == kind)
+            .values(ref_count=MediaAssets.ref_count + 1)
+            .returning(MediaAssets.id, MediaAssets.image_url, MediaAssets.thumbnail_url, MediaAssets.variant_urls)
+        ).first()
+        session.commit()
+    finally:
+        session.close()
+
+    if not asset:
+        return None
+    logger.info(f"Reusing stored {kind} asset {asset.id} for upload {staged_file['sha256']}")
+    return {**staged_file, "asset_id": asset.id, "image_url": asset.image_url, "thumbnail_url": asset.thumbnail_url, "variant_urls": asset.variant_urls or {}, "deduplicated": True}
+
+def record_media_asset(staged_file: dict, kind: str, image_url: str, thumbnail_url: str, variant_urls: dict = None) -> dict:
+    variant_urls = variant_urls or {}
+    session = Local_Session()
+    try:
+        inserted = session.execute(
+            pg_insert(MediaAssets)
+            .values(
+                sha256=staged_file["sha256"],
+                kind=kind,
+                image_url=image_url,
+                thumbnail_url=thumbnail_url,
+                variant_urls=variant_urls or None,
+                size_bytes=staged_file["size_bytes"],
+                ref_count=1,
+            )
+            .on_conflict_do_nothing(index_elements=["sha256", "kind"])
+            .returning(MediaAssets.id)
+        ).first()
+        session.commit()
+    finally:
+        session.close()
+
+    if inserted:
+        return {**staged_file, "asset_id": inserted.id, "image_url": image_url, "thumbnail_url": thumbnail_url, "variant_urls": variant_urls, "deduplicated": False}
+
+    # Another upload of the same bytes got there first, so our copy is an orphan the caller has to delete
+    asset = claim_media_asset(staged_file, kind)
+    if not asset:
+        # The winner was released again in the meantime
+        return record_media_asset(staged_file, kind, image_url, thumbnail_url, variant_urls)
+    return {**asset, "orphaned_urls": [image_url, thumbnail_url, *variant_urls.values()]}
+
+def hold_media_claim(db: Session, ingested_image: dict):
+    db.info.setdefault("media_claims", []).append(ingested_image["asset_id"])
+
+def undo_media_claims(asset_ids: list):
+    media_urls = []
+    session = Local_Session()
+    try:
+        for asset_id, count in Counter(asset_ids).items():
+            asset = session.execute(
+                update(MediaAssets)
+                .where(MediaAssets.id == asset_id)
+                .values(ref_count=MediaAssets.ref_count - count)
+                .returning(MediaAssets.ref_count, MediaAssets.image_url, MediaAssets.thumbnail_url, MediaAssets.variant_urls)
+            ).first()
+            if asset and asset.ref_count <= 0:
+                session.execute(delete(MediaAssets).where(MediaAssets.id == asset_id))
+                media_urls.extend([asset.image_url, asset.thumbnail_url, *(asset.variant_urls or {}).values()])
+        session.commit()
+    finally:
+        session.close()
+
+    if media_urls:
+        delete_orphaned_uploads(media_urls)
+
+@event.listens_for(Local_Session, "after_commit")
+def keep_committed_media_claims(session: Session):
+    session.info.pop("media_claims", None)
+
+@event.listens_for(Local_Session, "after_transaction_end")
+def undo_uncommitted_media_claims(session: Session, transaction):
+    # Reached without a commit on rollback and on close, which covers requests that raised
+    if transaction.parent is not None:
+        return
+    asset_ids = session.info.pop("media_claims", None)
+    if asset_ids:
+        image_executor.submit(undo_media_claims, asset_ids)
+
+async def ingest_staged_image(db: Session, staged_file: dict, kind: str = "product", folder: str = "uploads", thumbnail_folder: str = "thumbnails", public_id: str = None, variants: dict = None) -> dict:
+    staged_file = {**staged_file, **await run_image_task(read_image_metadata, staged_file)}
+    asset = await run_image_task(claim_media_asset, staged_file, kind)
+    if asset:
+        hold_media_claim(db, asset)
+        return asset
+
+    image_url, thumbnail_info = await asyncio.gather(
+        run_image_task(upload_original, staged_file["local_path"], folder, public_id),
+        run_image_task(create_thumbnail, image_path=staged_file["local_path"], folder=thumbnail_folder, variants=variants),
+        return_exceptions=True,
+    )
+    failure = next((result for result in (image_url, thumbnail_info) if isinstance(result, BaseException)), None)
+    if failure:
+        # Whichever half did upload would otherwise be left behind
+        stored = []
+        if not isinstance(image_url, BaseException):
+            stored.append(image_url)
+        if not isinstance(thumbnail_info, BaseException):
+            stored.extend(thumbnail_info["variants"].values())
+        await run_image_task(delete_orphaned_uploads, stored)
+        raise failure
+
+    # The grid variant is the thumbnail, only the larger ones are kept as variants
+    variant_urls = {name: url for name, url in thumbnail_info["variants"].items() if name != "grid"}
+    ingested_image = await run_image_task(record_media_asset, staged_file, kind, image_url, thumbnail_info["cloudinary_thumbnail_url"], variant_urls)
+    hold_media_claim(db, ingested_image)
+
+    orphaned_urls = ingested_image.pop("orphaned_urls", None)
+    if orphaned_urls:
+        await run_image_task(delete_orphaned_uploads, orphaned_urls)
+    return ingested_image
+
+async def ingest_image(db: Session, upload_file: UploadFile = None, image_url: str = None, kind: str = "product", folder: str = "uploads", thumbnail_folder: str = "thumbnails", public_id: str = None, variants: dict = None) -> dict:
+    if upload_file:
+        staged_file = await run_image_task(stage_upload, upload_file)
+    elif image_url:
+        staged_file = await run_image_task(stage_url, image_url)
+    else:
+        raise ValueError("Provide either upload_file or image_url")
+
+    try:
+        return await ingest_staged_image(db, staged_file, kind, folder, thumbnail_folder, public_id, variants)
+    finally:
+        scratch_storage.release(staged_file["local_path"])
+
+def release_media_asset(db: Session, image_url: str, kind: str) -> bool:
+    return image_url in release_media_assets(db, [image_url], kind)
+
+def release_media_assets(db: Session, image_urls: list, kind: str) -> set:
+    # One UPDATE for the whole batch, decremented in SQL so a concurrent reuse is not lost
+    counts = Counter(url for url in image_urls if url)
+    if not counts:
+        return set()
+
+    remaining = dict(db.execute(
+        update(MediaAssets)
+        .where(MediaAssets.image_url.in_(list(counts)), MediaAssets.kind == kind)
+        .values(ref_count=MediaAssets.ref_count - case(counts, value=MediaAssets.image_url))
+        .returning(MediaAssets.image_url, MediaAssets.ref_count)
+        .execution_options(synchronize_session=False)
+    ).all())
+
+    emptied = [image_url for image_url, ref_count in remaining.items() if ref_count <= 0]
+    if emptied:
+        db.execute(
+            delete(MediaAssets)
+            .where(MediaAssets.image_url.in_(emptied), MediaAssets.kind == kind)
+            .execution_options(synchronize_session=False)
+        )
+    # URLs with no asset row predate dedup and belong to their row alone
+    return {image_url for image_url in counts if image_url not in remaining or image_url in emptied}
+
+def delete_orphaned_uploads(urls: list):
+    public_ids = [media_storage.public_id_from_url(url) for url in urls if url]
+    result = media_storage.delete_many([public_id for public_id in public_ids if public_id])
+    if result["failed"]:
+        logger.warning(f"Could not delete orphaned uploads: {result['failed']}")
+
+async def delete_media_urls(urls) -> dict:
+    public_ids = []
+    for url in dict.fromkeys(url for url in urls if url):
+        public_id = media_storage.public_id_from_url(url)
+        if public_id:
+            public_ids.append(public_id)
+
+    batches = [public_ids[start:start + MEDIA_DELETE_BATCH_SIZE] for start in range(0, len(public_ids), MEDIA_DELETE_BATCH_SIZE)]
+    semaphore = asyncio.Semaphore(MEDIA_DELETE_CONCURRENCY)
+
+    async def delete_batch(batch):
+        async with semaphore:
+            return await run_image_task(media_storage.delete_many, batch)
+
+    results = await asyncio.gather(*(delete_batch(batch) for batch in batches), return_exceptions=True)
+
+    deleted, failed = 0, {}
+    for batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            failed.update({public_id: str(result) for public_id in batch})
+            continue
+        deleted += len(result["deleted"])
+        failed.update(result["failed"])
+
+    if failed:
+        logger.warning(f"Could not delete {len(failed)} of {len(public_ids)} media files")
+    return {"deleted": deleted, "failed": failed}
+
 async def save_pic_of_week(upload_file: UploadFile) -> dict:
-    if not os.path.exists(POEM_DIR):
-        os.makedirs(POEM_DIR)
-    
-    ext = os.path.splitext(upload_file.filename)[1] or ".jpg"
-    unique_filename = f"{uuid.uuid4().hex}{ext}"
-    file_path = os.path.join(POEM_DIR, unique_filename)
-    
-    with open(file_path, "wb") as f:
-        f.write(await upload_file.read())
-    
-    return {"local_path": file_path}
+    return await run_image_task(stage_upload, upload_file, POEM_DIR)
 
 def upload_pic_of_week(image_path: str = None, image_url: str = None) -> str:
     if image_path:
-        upload_result = cloudinary.uploader.upload(
-            image_path,
-            folder="picOfWeek",
-            resource_type="image",
-            overwrite=True,
-        )
+        return media_storage.upload(image_path, "picOfWeek")
     elif image_url:
-        response = requests.get(image_url)
-        upload_result = cloudinary.uploader.upload(
-            io.BytesIO(response.content),
-            folder="picOfWeek",
-            resource_type="image",
-            overwrite=True,
-        )
+        return media_storage.upload(io.BytesIO(fetch_remote_image(image_url)), "picOfWeek")
     else:
         raise ValueError("Provide either image_path or image_url")
-    
-    return upload_result["secure_url"]
 
 
+def get_products_by_ids(db: Session, product_ids) -> dict:
+    unique_ids = set(product_ids)
+    if not unique_ids:
+        return {}
+
+    products = db.query(Products).filter(Products.id.in_(unique_ids)).all()
+    return {product.id: product for product in products}
+
+def resolve_products(db: Session, product_ids) -> dict:
+    products = get_products_by_ids(db, product_ids)
+    for product_id in product_ids:
+        if product_id not in products:
+            raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
+    return products
+
 def send_order_confirmation_email(order: Orders, db: Session):
     download_links = []
+    products = get_products_by_ids(db, [item.product_id for item in order.items])
     
     has_physical_items = any(
         getattr(item.product_type, "value", item.product_type) == ProductType.physical.value 
@@ -167,7 +508,7 @@ def send_order_confirmation_email(order: Orders, db: Session):
 
     for item in order.items:
         if getattr(item.product_type, "value", item.product_type) == ProductType.digital.value:
-            product = db.query(Products).filter(Products.id == item.product_id).first()
+            product = products.get(item.product_id)
             if product and product.image_url:
                 download_links.append({
                     "title": product.title,
@@ -175,14 +516,14 @@ def send_order_confirmation_email(order: Orders, db: Session):
                 })
 
     if len(order.items) == 1:
-        product_title = order.items[0].product.title
+        product_title = products[order.items[0].product_id].title
     else:
-        product_title = ", ".join([item.product.title for item in order.items[:-1]]) + f" and {order.items[-1].product.title}"
+        product_title = ", ".join([products[item.product_id].title for item in order.items[:-1]]) + f" and {products[order.items[-1].product_id].title}"
 
     items_html = ""
     for item in order.items:
         item_type = getattr(item.product_type, "value", item.product_type)
-        items_html += f'<li style="margin-bottom: 8px; color: #333333; font-size: 15px;">{item.quantity}x {item.product.title} ({item_type})</li>'
+        items_html += f'<li style="margin-bottom: 8px; color: #333333; font-size: 15px;">{item.quantity}x {products[item.product_id].title} ({item_type})</li>'
 
     if download_links:
         links_html = "".join(
@@ -640,24 +981,9 @@ def calculate_order_shipping_and_tax(order_or_items, country_input, shipping_typ
 
     return shipping_cost, total_tax
 
-def extract_public_id_from_url(url: str) -> str:
-    try:
-        path = url.split("/upload/")[1]  # get "v1760238039/uploads/..."
-        path = path.split(".")[0]        # remove extension
-        parts = path.split("/")          # ['v1760238039', 'uploads', 'fileid']
-        public_id = "/".join(parts[1:])  # skip version number
-        return public_id
-    except Exception:
-        return None
-    
 def generate_signed_cloudinary_url(original_url: str, expiry_seconds: int = 3600):
-    public_id = extract_public_id_from_url(original_url)
+    public_id = media_storage.public_id_from_url(original_url)
     if not public_id:
         return original_url 
     
-    signed_url, _ = cloudinary.utils.cloudinary_url(
-        public_id,
-        resource_type="image",
-        sign_url=False,
-    )
-    return signed_url
+    return media_storage.url(public_id)
@@ -0,0 +1,103 @@
+import os
+import json
+import hashlib
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from tables import Local_Session, IdempotencyKeys
+
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", 24))
+# Must outlast a PaymentIntent.create, which Stripe's client lets run for 80s
+# per attempt, or a retry takes the key over and creates a second intent.
+# Raise it if stripe.max_network_retries is turned on.
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", 120))
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+def request_fingerprint(payload) -> str:
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(body.encode()).hexdigest()
+
+def begin_idempotent_request(db: Session, scope: str, key: str, fingerprint: str):
+    if not key:
+        return None
+    if len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be at most {MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+
+    now = datetime.now(timezone.utc)
+    expires_at = now + timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+
+    # The claim is committed straight away so a concurrent retry sees it
+    claimed = db.execute(
+        pg_insert(IdempotencyKeys)
+        .values(scope=scope, key=key, request_hash=fingerprint, created_at=now, expires_at=expires_at)
+        .on_conflict_do_nothing(index_elements=["scope", "key"])
+        .returning(IdempotencyKeys.id)
+    ).first()
+    if claimed:
+        db.commit()
+        return None
+
+    # An expired key, or a claim whose request died before finishing, can be taken over
+    taken_over = (
+        db.query(IdempotencyKeys)
+        .filter(
+            IdempotencyKeys.scope == scope,
+            IdempotencyKeys.key == key,
+            or_(
+                IdempotencyKeys.expires_at < now,
+                and_(IdempotencyKeys.response.is_(None), IdempotencyKeys.created_at < now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)),
+            ),
+        )
+        .update(
+            {"request_hash": fingerprint, "response": None, "status_code": None, "created_at": now, "expires_at": expires_at},
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+    if taken_over:
+        return None
+
+    record = db.query(IdempotencyKeys).filter(IdempotencyKeys.scope == scope, IdempotencyKeys.key == key).first()
+    if not record:
+        # Released by a failed request between our insert and this read
+        return begin_idempotent_request(db, scope, key, fingerprint)
+    if record.request_hash != fingerprint:
+        raise HTTPException(status_code=422, detail="This Idempotency-Key was already used with a different request")
+    if record.response is None:
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still being processed")
+
+    return JSONResponse(content=record.response, status_code=record.status_code, headers={"Idempotent-Replayed": "true"})
+
+def complete_idempotent_request(db: Session, scope: str, key: str, response, status_code: int = 200):
+    # Called before the caller commits, so the stored response lands with the rows it describes
+    if not key:
+        return
+    db.query(IdempotencyKeys).filter(IdempotencyKeys.scope == scope, IdempotencyKeys.key == key).update(
+        {"response": jsonable_encoder(response), "status_code": status_code},
+        synchronize_session=False,
+    )
+
+def release_idempotent_request(db: Session, scope: str, key: str):
+    # A failed request gives its key back so the client can retry it
+    if not key:
+        return
+    db.rollback()
+    db.query(IdempotencyKeys).filter(
+        IdempotencyKeys.scope == scope,
+        IdempotencyKeys.key == key,
+        IdempotencyKeys.response.is_(None),
+    ).delete(synchronize_session=False)
+    db.commit()
+
+def purge_expired_idempotency_keys() -> bool:
+    db = Local_Session()
+    try:
+        db.query(IdempotencyKeys).filter(IdempotencyKeys.expires_at < datetime.now(timezone.utc)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    return False
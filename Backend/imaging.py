@@ -0,0 +1,29 @@
+import io
+from PIL import Image
+
+IMAGE_VARIANTS = {
+    "grid": (150, 150),
+    "detail": (800, 800),
+    "zoom": (1600, 1600),
+}
+
+def render_image_variants(source, variants: dict = None) -> dict:
+    variants = variants or IMAGE_VARIANTS
+    ordered_variants = sorted(variants.items(), key=lambda variant: variant[1][0] * variant[1][1], reverse=True)
+    rendered = {}
+
+    with Image.open(source) as img:
+        # JPEGs decode straight to the smallest DCT scale that still covers the
+        # largest variant, which skips most of the work for big originals
+        img.draft("RGB", ordered_variants[0][1])
+        working = img.convert("RGB") if img.mode not in ("RGB", "L") else img.copy()
+
+    # Each variant is shrunk from the previous, larger one and encoded in memory
+    for name, size in ordered_variants:
+        working.thumbnail(size)
+        buffer = io.BytesIO()
+        working.save(buffer, format="JPEG")
+        buffer.seek(0)
+        rendered[name] = buffer
+
+    return rendered
@@ -0,0 +1,533 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from fastapi.responses import JSONResponse
+from sqlalchemy import and_, or_, func, event
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from tables import Local_Session, ImageJobs, EmailOutbox, StripeEvents, Orders, OrderItem, CheckoutInfo, Shipping, Products, Portfolio, PortfolioImages
+from schemas import JobStatusType, StatusType, ProductType
+from func import generate_slug, stage_url, ingest_staged_image, IMAGE_VARIANTS, scratch_storage, release_media_assets, delete_orphaned_uploads, send_order_confirmation_email, send_order_status_email
+from cache import invalidate_products, invalidate_portfolios
+from idempotency import purge_expired_idempotency_keys
+
+logger = logging.getLogger(__name__)
+
+IMAGE_JOB_WORKERS = int(os.getenv("IMAGE_JOB_WORKERS", 2))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", 1.0))
+JOB_TIMEOUT_SECONDS = int(os.getenv("JOB_TIMEOUT_SECONDS", 900))
+JOB_RETRY_BASE_SECONDS = int(os.getenv("JOB_RETRY_BASE_SECONDS", 5))
+EMAIL_WORKERS = int(os.getenv("EMAIL_WORKERS", 2))
+EMAIL_TIMEOUT_SECONDS = int(os.getenv("EMAIL_TIMEOUT_SECONDS", 300))
+EMAIL_RETRY_BASE_SECONDS = int(os.getenv("EMAIL_RETRY_BASE_SECONDS", 30))
+STRIPE_EVENT_WORKERS = int(os.getenv("STRIPE_EVENT_WORKERS", 2))
+STRIPE_EVENT_RETRY_BASE_SECONDS = int(os.getenv("STRIPE_EVENT_RETRY_BASE_SECONDS", 5))
+
+class PermanentJobError(Exception):
+    pass
+
+class WorkerPool:
+    def __init__(self, name: str, poll, size: int = 1, idle_seconds: float = JOB_POLL_SECONDS):
+        self.name = name
+        self.poll = poll
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._stop_event.clear()
+        for index in range(self.size):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.size:
+            logger.info(f"Started {self.size} {self.name} workers")
+
+    def stop(self, timeout: float = 10):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                worked = self.poll()
+            except Exception:
+                logger.exception(f"{self.name} worker crashed while polling")
+                worked = False
+
+            # Keep draining while there is work, otherwise back off until the next poll
+            if not worked:
+                self._stop_event.wait(self.idle_seconds)
+
+def enqueue_job(db: Session, kind: str, payload: dict) -> ImageJobs:
+    job = ImageJobs(kind=kind, payload=payload, status=JobStatusType.queued)
+    db.add(job)
+    db.flush()
+    return job
+
+def job_accepted(job: ImageJobs) -> JSONResponse:
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": job.id, "status": job.status.value},
+        headers={"Location": f"/jobs/{job.id}"},
+    )
+
+# Workers run on plain threads, so each ingest gets a short-lived event loop
+# and shares the request path's ingest_staged_image, cleanup included.
+def process_product_job(db: Session, job: ImageJobs) -> dict:
+    payload = job.payload
+    # Checked before anything is uploaded, a retry would only fail the same way
+    missing = [field for field in ("title", "price") if payload.get(field) is None]
+    if not payload.get("local_path") and not payload.get("image_url"):
+        missing.append("image")
+    if missing:
+        raise PermanentJobError(f"Missing required fields: {', '.join(missing)}")
+
+    slug = generate_slug(payload["title"])
+
+    if db.query(Products).filter(or_(Products.title == payload["title"], Products.slug == slug)).first():
+        raise PermanentJobError("A product under this title already exists")
+
+    if payload.get("local_path"):
+        if not os.path.exists(payload["local_path"]):
+            raise PermanentJobError("The staged upload is no longer on disk, please upload it again")
+        staged_file = {key: payload[key] for key in ("local_path", "size_bytes", "sha256")}
+        scratch_storage.register(staged_file["local_path"], staged_file["size_bytes"])
+        ingested_image = asyncio.run(ingest_staged_image(db, staged_file, variants=IMAGE_VARIANTS))
+    else:
+        # A retry downloads the image again, so there is nothing worth keeping on disk
+        staged_file = stage_url(payload["image_url"])
+        try:
+            ingested_image = asyncio.run(ingest_staged_image(db, staged_file, variants=IMAGE_VARIANTS))
+        finally:
+            scratch_storage.release(staged_file["local_path"])
+
+    product = Products(
+        title=payload["title"],
+        slug=slug,
+        description=payload.get("description"),
+        image_url=ingested_image["image_url"],
+        thumbnail_url=ingested_image["thumbnail_url"],
+        variant_urls=ingested_image["variant_urls"] or None,
+        price=payload["price"],
+        is_for_sale=payload.get("is_for_sale", True),
+        dimensions=payload.get("dimensions"),
+        resolution=payload.get("resolution") or ingested_image["resolution"],
+        file_size_mb=payload.get("file_size_mb") or ingested_image["file_size_mb"],
+        file_format=payload.get("file_format") or ingested_image["file_format"],
+    )
+    db.add(product)
+    try:
+        db.flush()
+    except IntegrityError as e:
+        # Rolling back gives the claimed asset back, so this attempt's uploads are deleted
+        raise PermanentJobError(f"Could not save the product: {e.orig}") from e
+
+    return {"product_id": product.id, "slug": product.slug}
+
+def process_portfolio_job(db: Session, job: ImageJobs) -> dict:
+    payload = job.payload
+    portfolio = db.query(Portfolio).filter(Portfolio.id == payload["portfolio_id"]).first()
+    if not portfolio:
+        raise PermanentJobError("Portfolio no longer exists")
+
+    # Images are committed one by one, so a retry picks up where the last attempt stopped
+    processed = list((job.result or {}).get("processed", []))
+    total = len(payload["files"])
+
+    pending = [(index, staged_file) for index, staged_file in enumerate(payload["files"]) if index not in processed]
+    for index, staged_file in pending:
+        if not os.path.exists(staged_file["local_path"]):
+            raise PermanentJobError(f"Staged file {index} is no longer on disk, please upload it again")
+        # Pinned in this process until the job releases it, so eviction cannot take it mid-job
+        scratch_storage.register(staged_file["local_path"], staged_file["size_bytes"])
+
+    for index, staged_file in pending:
+        ingested_image = asyncio.run(ingest_staged_image(
+            db,
+            staged_file,
+            kind="portfolio",
+            folder=payload["folder"],
+            thumbnail_folder="portfolio_thumbnail",
+            public_id=staged_file["public_id"],
+        ))
+        db.add(PortfolioImages(
+            portfolio_id=portfolio.id,
+            image_url=ingested_image["image_url"],
+            thumbnail_url=ingested_image["thumbnail_url"],
+        ))
+
+        processed.append(index)
+        job.result = {"portfolio_id": portfolio.id, "processed": processed, "total": total}
+        db.commit()
+        scratch_storage.release(staged_file["local_path"])
+
+    # Committed with the job, so the listings only ever see a complete portfolio
+    portfolio.is_published = True
+    return {"portfolio_id": portfolio.id, "processed": processed, "total": total}
+
+def discard_portfolio_job(db: Session, job: ImageJobs):
+    # The portfolio was never published, so only its own images reference it
+    portfolio = (
+        db.query(Portfolio)
+        .filter(Portfolio.id == job.payload["portfolio_id"], Portfolio.is_published.is_(False))
+        .first()
+    )
+    if not portfolio:
+        return
+
+    images = db.query(PortfolioImages.image_url, PortfolioImages.thumbnail_url).filter(PortfolioImages.portfolio_id == portfolio.id).all()
+    releasable = release_media_assets(db, [img.image_url for img in images], "portfolio")
+    media_urls = [url for img in images if img.image_url in releasable for url in (img.image_url, img.thumbnail_url)]
+
+    db.query(PortfolioImages).filter(PortfolioImages.portfolio_id == portfolio.id).delete(synchronize_session=False)
+    db.delete(portfolio)
+    db.commit()
+    delete_orphaned_uploads(media_urls)
+
+def staged_paths(payload: dict) -> list:
+    if payload.get("local_path"):
+        return [payload["local_path"]]
+    return [staged_file["local_path"] for staged_file in payload.get("files", [])]
+
+JOB_HANDLERS = {
+    "product": (process_product_job, invalidate_products),
+    "portfolio": (process_portfolio_job, invalidate_portfolios),
+}
+
+# Undo whatever a permanently failed job left behind
+JOB_FAILURE_HANDLERS = {
+    "portfolio": discard_portfolio_job,
+}
+
+class RetryLater(Exception):
+    pass
+
+def claim_next(db: Session, model, timeout_seconds: int, order_by=None):
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=timeout_seconds)
+
+    # A row left running by a worker that died is picked up again once it goes stale
+    row = (
+        db.query(model)
+        .filter(or_(
+            and_(model.status == JobStatusType.queued, model.run_after <= func.now()),
+            and_(model.status == JobStatusType.running, model.updated_at < stale_before),
+        ))
+        .order_by(*(order_by or (model.run_after, model.id)))
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if not row:
+        return None
+
+    row.status = JobStatusType.running
+    row.attempts += 1
+    db.commit()
+    return row
+
+def claim_image_job(db: Session):
+    return claim_next(db, ImageJobs, JOB_TIMEOUT_SECONDS)
+
+def run_next_image_job() -> bool:
+    db = Local_Session()
+    try:
+        job = claim_image_job(db)
+        if not job:
+            return False
+
+        job_id = job.id
+        handler, on_success = JOB_HANDLERS[job.kind]
+        try:
+            result = handler(db, job)
+            job.status = JobStatusType.succeeded
+            job.result = result
+            job.error = None
+            db.commit()
+            for path in staged_paths(job.payload):
+                scratch_storage.release(path)
+            on_success()
+        except Exception as e:
+            db.rollback()
+            job = db.get(ImageJobs, job_id)
+            job.error = str(e)
+
+            if not isinstance(e, PermanentJobError) and job.attempts < job.max_attempts:
+                delay = min(JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1), 600)
+                job.status = JobStatusType.queued
+                job.run_after = datetime.now(timezone.utc) + timedelta(seconds=delay)
+                logger.warning(f"Image job {job_id} failed on attempt {job.attempts}, retrying in {delay}s: {e}")
+            else:
+                job.status = JobStatusType.failed
+                for path in staged_paths(job.payload):
+                    scratch_storage.discard(path)
+                logger.error(f"Image job {job_id} failed permanently: {e}")
+            db.commit()
+
+            on_failure = JOB_FAILURE_HANDLERS.get(job.kind)
+            if job.status == JobStatusType.failed and on_failure:
+                try:
+                    on_failure(db, job)
+                except Exception:
+                    db.rollback()
+                    logger.exception(f"Could not clean up after failed image job {job_id}")
+
+        return True
+    finally:
+        db.close()
+
+EMAIL_SENDERS = {
+    "order_confirmation": send_order_confirmation_email,
+    "order_status": send_order_status_email,
+}
+
+email_metrics_lock = threading.Lock()
+email_metrics = {"queued": 0, "deduplicated": 0, "sent": 0, "retried": 0, "failed": 0, "last_send_seconds": None}
+
+def record_email_metric(name: str, value=1):
+    with email_metrics_lock:
+        if name == "last_send_seconds":
+            email_metrics[name] = value
+        else:
+            email_metrics[name] += value
+
+def enqueue_email(db: Session, kind: str, order_id: int, dedupe_key: str = None) -> EmailOutbox:
+    # Written in the caller's transaction, so the email exists exactly when the order does
+    dedupe_key = dedupe_key or f"{kind}:{order_id}"
+    inserted = db.execute(
+        pg_insert(EmailOutbox)
+        .values(order_id=order_id, kind=kind, dedupe_key=dedupe_key, status=JobStatusType.queued)
+        .on_conflict_do_nothing(index_elements=["dedupe_key"])
+        .returning(EmailOutbox.id)
+    ).first()
+    # Counted once the caller commits, a rolled back order queued nothing
+    db.info.setdefault("email_metrics", []).append("queued" if inserted else "deduplicated")
+    return db.query(EmailOutbox).filter(EmailOutbox.dedupe_key == dedupe_key).one()
+
+@event.listens_for(Local_Session, "after_commit")
+def record_committed_email_metrics(session: Session):
+    for name in session.info.pop("email_metrics", []):
+        record_email_metric(name)
+
+@event.listens_for(Local_Session, "after_rollback")
+def drop_rolled_back_email_metrics(session: Session):
+    session.info.pop("email_metrics", None)
+
+def requeue_email(email: EmailOutbox):
+    email.status = JobStatusType.queued
+    email.attempts = 0
+    email.error = None
+    email.run_after = func.now()
+
+def run_next_email() -> bool:
+    db = Local_Session()
+    try:
+        email = claim_next(db, EmailOutbox, EMAIL_TIMEOUT_SECONDS)
+        if not email:
+            return False
+
+        email_id = email.id
+        try:
+            order = db.query(Orders).filter(Orders.id == email.order_id).first()
+            if not order:
+                raise PermanentJobError("Order no longer exists")
+
+            started = time.monotonic()
+            response = EMAIL_SENDERS[email.kind](order, db)
+            record_email_metric("last_send_seconds", round(time.monotonic() - started, 3))
+
+            email.status = JobStatusType.succeeded
+            email.sent_at = func.now()
+            email.error = None
+            email.provider_message_id = (response or {}).get("id")
+            db.commit()
+            record_email_metric("sent")
+        except Exception as e:
+            db.rollback()
+            email = db.get(EmailOutbox, email_id)
+            email.error = str(e)
+
+            if not isinstance(e, PermanentJobError) and email.attempts < email.max_attempts:
+                delay = min(EMAIL_RETRY_BASE_SECONDS * 2 ** (email.attempts - 1), 3600)
+                email.status = JobStatusType.queued
+                email.run_after = datetime.now(timezone.utc) + timedelta(seconds=delay)
+                record_email_metric("retried")
+                logger.warning(f"Email {email_id} failed on attempt {email.attempts}, retrying in {delay}s: {e}")
+            else:
+                email.status = JobStatusType.failed
+                record_email_metric("failed")
+                logger.error(f"Email {email_id} failed permanently: {e}")
+            db.commit()
+
+        return True
+    finally:
+        db.close()
+
+def email_outbox_stats(db: Session) -> dict:
+    by_status = dict(db.query(EmailOutbox.status, func.count(EmailOutbox.id)).group_by(EmailOutbox.status).all())
+    oldest_queued = db.query(func.min(EmailOutbox.created_at)).filter(EmailOutbox.status == JobStatusType.queued).scalar()
+
+    with email_metrics_lock:
+        metrics = dict(email_metrics)
+    return {
+        "outbox": {status.value: by_status.get(status, 0) for status in JobStatusType},
+        "oldest_queued_at": oldest_queued,
+        "this_process": metrics,
+    }
+
+def record_stripe_event(db: Session, event: dict) -> bool:
+    data_object = event.get("data", {}).get("object", {})
+    inserted = db.execute(
+        pg_insert(StripeEvents)
+        .values(
+            id=event["id"],
+            type=event["type"],
+            object_id=data_object.get("id"),
+            stripe_created=event.get("created", 0),
+            payload=event,
+            status=JobStatusType.queued,
+        )
+        .on_conflict_do_nothing(index_elements=["id"])
+        .returning(StripeEvents.id)
+    ).first()
+    return inserted is not None
+
+def lock_checkout(db: Session, transaction_id: str):
+    # Events for one PaymentIntent are applied one at a time, whichever worker holds them
+    return (
+        db.query(CheckoutInfo)
+        .filter(CheckoutInfo.transaction_id == transaction_id)
+        .with_for_update()
+        .first()
+    )
+
+def process_payment_succeeded(db: Session, event: dict):
+    intent = event["data"]["object"]
+    metadata = intent.get("metadata", {})
+
+    checkout_info = lock_checkout(db, intent["id"])
+    if not checkout_info:
+        # create-intent commits after Stripe answers, so the event can beat the row
+        raise RetryLater(f"Checkout not found for transaction: {intent['id']}")
+    if checkout_info.order_id:
+        logger.info(f"Order {checkout_info.order_id} already exists for transaction {intent['id']}")
+        return
+
+    checkout_info.payment_status = StatusType.succeeded.value
+    checkout_info.amount_paid = checkout_info.amount_to_be_paid
+
+    has_physical = any(
+        getattr(item.product_type, "value", item.product_type) == ProductType.physical.value 
+        for item in checkout_info.items
+    )
+    order_status = StatusType.ordered if has_physical else StatusType.delivered
+
+    order = Orders(
+        customer_name=checkout_info.customer_name,
+        customer_email=checkout_info.email,
+        phone_number=checkout_info.phone_number,
+        status=order_status,
+        order_total=checkout_info.amount_to_be_paid,
+    )
+    db.add(order)
+    db.flush()
+
+    db.query(OrderItem).filter(OrderItem.checkout_info_id == checkout_info.id).update({"order_id": order.id}, synchronize_session=False)
+    checkout_info.order_id = order.id
+
+    if metadata.get("has_physical") == "true":
+        db.add(Shipping(
+            order_id=order.id,
+            address_line1=metadata.get("shipping_address_line1", ""),
+            address_line2=metadata.get("shipping_address_line2", ""),
+            city=metadata.get("shipping_city", ""),
+            state=metadata.get("shipping_state", ""),
+            postal_code=metadata.get("shipping_postal_code", ""),
+            country_code=metadata.get("shipping_country_code", ""),
+            shipping_fee=float(metadata.get("shipping_fee", 0)),
+            tax=float(metadata.get("shipping_tax", 0))
+        ))
+
+    enqueue_email(db, "order_confirmation", order.id)
+    logger.info(f"Order {order.id} created for transaction {intent['id']}")
+
+def process_payment_failed(db: Session, event: dict):
+    intent = event["data"]["object"]
+
+    checkout_info = lock_checkout(db, intent["id"])
+    if not checkout_info:
+        raise RetryLater(f"Checkout not found for transaction: {intent['id']}")
+
+    # A failed attempt delivered after the payment went through must not undo it
+    if checkout_info.order_id or checkout_info.payment_status == StatusType.succeeded:
+        logger.info(f"Ignoring late payment_failed event for transaction {intent['id']}")
+        return
+    checkout_info.payment_status = StatusType.failed.value
+
+STRIPE_EVENT_HANDLERS = {
+    "payment_intent.succeeded": process_payment_succeeded,
+    "payment_intent.payment_failed": process_payment_failed,
+}
+
+def run_next_stripe_event() -> bool:
+    db = Local_Session()
+    try:
+        # Oldest Stripe event first, claim_next only returns rows whose run_after has passed
+        event_row = claim_next(db, StripeEvents, JOB_TIMEOUT_SECONDS, order_by=(StripeEvents.stripe_created, StripeEvents.id))
+        if not event_row:
+            return False
+
+        event_id = event_row.id
+        try:
+            STRIPE_EVENT_HANDLERS[event_row.type](db, event_row.payload)
+            event_row.status = JobStatusType.succeeded
+            event_row.processed_at = func.now()
+            event_row.error = None
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            event_row = db.get(StripeEvents, event_id)
+            event_row.error = str(e)
+
+            if not isinstance(e, PermanentJobError) and event_row.attempts < event_row.max_attempts:
+                delay = min(STRIPE_EVENT_RETRY_BASE_SECONDS * 2 ** (event_row.attempts - 1), 3600)
+                event_row.status = JobStatusType.queued
+                event_row.run_after = datetime.now(timezone.utc) + timedelta(seconds=delay)
+                log = logger.info if isinstance(e, RetryLater) else logger.warning
+                log(f"Stripe event {event_id} not processed on attempt {event_row.attempts}, retrying in {delay}s: {e}")
+            else:
+                event_row.status = JobStatusType.failed
+                logger.error(f"Stripe event {event_id} failed permanently: {e}")
+            db.commit()
+
+        return True
+    finally:
+        db.close()
+
+# Caches are per process, so workers only invalidate the caches of the process
+# they run in. Run them inside the API process unless you accept stale listings.
+image_job_pool = WorkerPool("image-jobs", run_next_image_job, size=IMAGE_JOB_WORKERS)
+email_pool = WorkerPool("email-outbox", run_next_email, size=EMAIL_WORKERS)
+stripe_event_pool = WorkerPool("stripe-events", run_next_stripe_event, size=STRIPE_EVENT_WORKERS)
+idempotency_purge_pool = WorkerPool("idempotency-purge", purge_expired_idempotency_keys, idle_seconds=3600)
+
+WORKER_POOLS = [image_job_pool, email_pool, stripe_event_pool, idempotency_purge_pool]
+
+def start_workers():
+    for pool in WORKER_POOLS:
+        pool.start()
+
+def stop_workers():
+    for pool in WORKER_POOLS:
+        pool.stop()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    start_workers()
+    threading.Event().wait()
@@ -0,0 +1,188 @@
+import sys
+import time
+import uuid
+import argparse
+import threading
+from collections import Counter
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Steady closed-loop load against a running API, for before/after comparisons.
+# seed writes tagged rows straight to the database, so point PGDB at a scratch one.
+#
+#   python load_test.py seed --products 500 --portfolios 50 --images 10
+#   python load_test.py get /products/view-photos-table /view-all-portfolios --duration 15 --concurrency 16
+#   python load_test.py orders --duration 15 --concurrency 8
+#   python load_test.py seed --clear
+
+SEED_PREFIX = "load-test-"
+
+def seed(products: int, portfolios: int, images: int):
+    from tables import Local_Session, Products, Portfolio, PortfolioImages
+    from schemas import PortfolioType
+
+    db = Local_Session()
+    try:
+        run = uuid.uuid4().hex[:8]
+        db.add_all(
+            Products(
+                title=f"{SEED_PREFIX}{run}-{index}",
+                slug=f"{SEED_PREFIX}{run}-{index}",
+                description="Seeded for load testing",
+                image_url=f"/media/uploads/{run}-{index}.jpg",
+                thumbnail_url=f"/media/thumbnails/{run}-{index}_grid.jpg",
+                price=25,
+                is_for_sale=True,
+            )
+            for index in range(products)
+        )
+        for index in range(portfolios):
+            portfolio = Portfolio(title=f"{SEED_PREFIX}{run}-{index}", slug=f"{SEED_PREFIX}{run}-{index}", category=list(PortfolioType)[index % len(PortfolioType)])
+            db.add(portfolio)
+            db.flush()
+            db.add_all(
+                PortfolioImages(portfolio_id=portfolio.id, image_url=f"/media/portfolio/{run}-{index}-{image}.jpg", thumbnail_url=f"/media/portfolio_thumbnail/{run}-{index}-{image}_grid.jpg")
+                for image in range(images)
+            )
+        db.commit()
+    finally:
+        db.close()
+    print(f"Seeded {products} products and {portfolios} portfolios with {images} images each")
+
+def clear_seed():
+    from tables import Local_Session, Products, Portfolio, PortfolioImages, OrderItem
+
+    db = Local_Session()
+    try:
+        portfolio_ids = db.query(Portfolio.id).filter(Portfolio.title.startswith(SEED_PREFIX))
+        db.query(PortfolioImages).filter(PortfolioImages.portfolio_id.in_(portfolio_ids.scalar_subquery())).delete(synchronize_session=False)
+        portfolios = db.query(Portfolio).filter(Portfolio.title.startswith(SEED_PREFIX)).delete(synchronize_session=False)
+
+        # Orders placed against seeded products keep them, the way the API does
+        ordered = db.query(OrderItem.product_id).distinct().scalar_subquery()
+        products = db.query(Products).filter(Products.title.startswith(SEED_PREFIX), Products.id.notin_(ordered)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    print(f"Removed {products} products and {portfolios} portfolios")
+
+def seeded_products(base_url: str, count: int) -> list:
+    catalog = requests.get(f"{base_url}/products/view-photos-table", timeout=30).json()
+    products = [product for product in catalog if product["title"].startswith(SEED_PREFIX)][:count]
+    if not products:
+        sys.exit("No seeded products found, run python load_test.py seed first")
+    return products
+
+def run_load(send, duration: float, concurrency: int):
+    statuses = Counter()
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(number: int):
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        local_statuses = Counter()
+        local_latencies = []
+        sent = 0
+
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                status = send(session, number, sent)
+            except requests.RequestException as e:
+                status = type(e).__name__
+            local_latencies.append(time.perf_counter() - started)
+            local_statuses[status] += 1
+            sent += 1
+
+        with lock:
+            statuses.update(local_statuses)
+            latencies.extend(local_latencies)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"{len(latencies)} requests in {elapsed:.2f}s ({len(latencies) / elapsed:.1f}/s), concurrency {concurrency}")
+    print(f"Responses: {dict(statuses)}")
+    if latencies:
+        print(f"Latency p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms")
+
+def load_get(base_url: str, paths: list, duration: float, concurrency: int, revalidate: bool):
+    etags = {}
+
+    def send(session, number, sent):
+        path = paths[(number + sent) % len(paths)]
+        headers = {"If-None-Match": etags[path]} if revalidate and path in etags else {}
+        response = session.get(f"{base_url}{path}", headers=headers, timeout=30)
+        if revalidate and "ETag" in response.headers:
+            etags[path] = response.headers["ETag"]
+        return response.status_code
+
+    run_load(send, duration, concurrency)
+
+def load_orders(base_url: str, items: int, duration: float, concurrency: int, idempotency_keys: bool):
+    cart = [
+        {"product_id": product["id"], "name": product["title"], "price": product["price"], "quantity": 1, "product_type": "digital"}
+        for product in seeded_products(base_url, items)
+    ]
+
+    def send(session, number, sent):
+        # order_data and shipping are both body params, so FastAPI expects them embedded
+        body = {"order_data": {
+            "customer_name": "Load Test",
+            "customer_email": f"load-test+{number}-{sent}@example.com",
+            "phone_number": "07000000000",
+            "items": cart,
+        }}
+        headers = {"Idempotency-Key": uuid.uuid4().hex} if idempotency_keys else {}
+        return session.post(f"{base_url}/order", json=body, headers=headers, timeout=30).status_code
+
+    run_load(send, duration, concurrency)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the storefront reads and order creation")
+    parser.add_argument("--url", default="http://localhost:8000")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="Insert tagged products and portfolios to load test against")
+    seed_parser.add_argument("--products", type=int, default=500)
+    seed_parser.add_argument("--portfolios", type=int, default=50)
+    seed_parser.add_argument("--images", type=int, default=10)
+    seed_parser.add_argument("--clear", action="store_true", help="Remove the seeded rows instead")
+
+    get_parser = commands.add_parser("get", help="GET the given paths in a loop and report requests/sec")
+    get_parser.add_argument("paths", nargs="+")
+    get_parser.add_argument("--duration", type=float, default=15)
+    get_parser.add_argument("--concurrency", type=int, default=16)
+    get_parser.add_argument("--revalidate", action="store_true", help="Send the last ETag back as If-None-Match")
+
+    orders_parser = commands.add_parser("orders", help="POST /order in a loop and report orders/sec")
+    orders_parser.add_argument("--items", type=int, default=3, help="Seeded products per order")
+    orders_parser.add_argument("--duration", type=float, default=15)
+    orders_parser.add_argument("--concurrency", type=int, default=8)
+    orders_parser.add_argument("--idempotency-keys", action="store_true", help="Send a fresh Idempotency-Key with every order")
+
+    args = parser.parse_args()
+    base_url = args.url.rstrip("/")
+    if args.command == "seed":
+        if args.clear:
+            clear_seed()
+        else:
+            seed(args.products, args.portfolios, args.images)
+    elif args.command == "get":
+        load_get(base_url, args.paths, args.duration, args.concurrency, args.revalidate)
+    else:
+        load_orders(base_url, args.items, args.duration, args.concurrency, args.idempotency_keys)
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,21 @@ from contextlib import asynccontextmanager
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session
 from fastapi.responses import HTMLResponse
+from fastapi.staticfiles import StaticFiles
 import asyncio
 from dataclasses import dataclass
-from products import products_router, portfolio_router, poem_router, admin_router
+from products import products_router, portfolio_router, poem_router, admin_router, jobs_router
 from purchase import orders_router, payment_router, email_router, checkout_router, shipping_router
+from jobs import start_workers, stop_workers
+from func import media_storage
 
-app = FastAPI(title="UIAPhotography API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_workers()
+    yield
+    stop_workers()
+
+app = FastAPI(title="UIAPhotography API", lifespan=lifespan)
 
 @dataclass
 class ConnectionManager:
@@ -38,6 +47,7 @@ app.add_middleware(
     allow_credentials=True,      
     allow_methods=["*"],          
     allow_headers=["*"],           
+    expose_headers=["X-Next-Cursor", "Location", "Idempotent-Replayed"],
 )
 
 app.include_router(admin_router, tags=["Admin"])
@@ -48,4 +58,8 @@ app.include_router(orders_router, tags=["Orders"])
 app.include_router(payment_router, tags=["Payment"])
 app.include_router(email_router, tags=["Email"])
 app.include_router(checkout_router, tags=["Checkout"])
-app.include_router(shipping_router, tags=["Shipping"])
\ No newline at end of file
+app.include_router(shipping_router, tags=["Shipping"])
+app.include_router(jobs_router, tags=["Jobs"])
+
+if media_storage.name == "local":
+    app.mount(media_storage.mount_path, StaticFiles(directory=media_storage.root), name="media")
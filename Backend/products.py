@@ -1,20 +1,46 @@
-from fastapi import APIRouter, Depends, HTTPException, Form, File, UploadFile, Body
-from sqlalchemy.orm import Session
-import cloudinary
-import cloudinary.uploader
-from schemas import AddProductsbyUrlInfo, ProductsData, AddProductMetafield, EditProductsData, PortfolioType, PortfolioCreate, PortfolioResponse, PortfolioImageResponse, PicOfTheWeekResponse, AdminCreate
-from tables import get_db, Admin, Products, OrderItem, Portfolio, PortfolioImages, PicOfTheWeek
-from func import generate_slug, save_upload_file, create_thumbnail, save_pic_of_week, upload_pic_of_week, hash_password, verify_password
+from fastapi import APIRouter, Depends, HTTPException, Form, File, UploadFile, Body, Query, Request, Response
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import func, tuple_
+from schemas import AddProductsbyUrlInfo, ProductsData, AddProductMetafield, EditProductsData, PortfolioType, PortfolioCreate, PortfolioResponse, PortfolioImageResponse, PicOfTheWeekResponse, AdminCreate, ImageJobResponse
+from tables import get_db, Admin, Products, OrderItem, Portfolio, PortfolioImages, PicOfTheWeek, ImageJobs
+from func import generate_slug, ingest_image, release_media_asset, release_media_assets, delete_media_urls, stage_upload, scratch_storage, save_pic_of_week, upload_pic_of_week, hash_password, verify_password, run_image_task, fetch_table_page, page_response, snapshot_response, encode_cursor, decode_cursor, build_prefix_tsquery, get_products_by_ids, IMAGE_VARIANTS, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, PORTFOLIO_UPLOAD_CONCURRENCY
+from cache import build_snapshot, catalog_cache, product_slug_cache, portfolio_cache, portfolio_category_cache, pic_of_week_cache, current_pic_of_week_cache, invalidate_products, invalidate_portfolios, invalidate_pics_of_week, cache_stats
 from typing import Optional, List
-from urllib.parse import unquote
+import asyncio
+from jobs import enqueue_job, job_accepted, email_outbox_stats
 
 products_router = APIRouter()
 portfolio_router = APIRouter()
 poem_router = APIRouter()
 admin_router = APIRouter()
+jobs_router = APIRouter()
+
+async def enqueue_upload_job(db: Session, kind: str, files: List[UploadFile], build_payload):
+    staged_files = await asyncio.gather(*(run_image_task(stage_upload, file) for file in files), return_exceptions=True)
+    enqueued = False
+    try:
+        failure = next((result for result in staged_files if isinstance(result, BaseException)), None)
+        if failure:
+            raise failure
+
+        job = enqueue_job(db, kind, build_payload(staged_files))
+        # Handed off before the commit, so a worker in this process can claim the job straight away
+        for staged_file in staged_files:
+            scratch_storage.hand_off(staged_file["local_path"])
+        db.commit()
+        enqueued = True
+    finally:
+        # Once the job is committed it owns the staged files, until then nothing else removes them
+        if not enqueued:
+            db.rollback()
+            for staged_file in staged_files:
+                if not isinstance(staged_file, BaseException):
+                    scratch_storage.discard(staged_file["local_path"])
+
+    return job
 
 @products_router.post("/add-photos-url", response_model=ProductsData)
-async def add_new_photos_via_url(text: AddProductsbyUrlInfo, db: Session = Depends(get_db)):
+async def add_new_photos_via_url(text: AddProductsbyUrlInfo, defer: bool = False, db: Session = Depends(get_db)):
     add_info_query = db.query(Products).filter(Products.title == text.title).first()
 
     if add_info_query:
@@ -23,36 +49,40 @@ async def add_new_photos_via_url(text: AddProductsbyUrlInfo, db: Session = Depen
     if db.query(Products).filter(Products.slug == generate_slug(text.title)).first():
         raise HTTPException(status_code=400, detail="Slug already exists. Please change the title.")
 
-    upload_result = cloudinary.uploader.upload(
-        str(text.image_url),
-        folder="uploads",
-        resource_type="image",
-        overwrite=True,
-    )
-    thumbnail_info = create_thumbnail(image_url=str(text.image_url))
+    if text.price is None:
+        raise HTTPException(status_code=400, detail="Kindly provide a price for this product")
+
+    if defer:
+        job = enqueue_job(db, "product", text.model_dump(mode="json"))
+        db.commit()
+        return job_accepted(job)
+
+    ingested_image = await ingest_image(db, image_url=str(text.image_url), variants=IMAGE_VARIANTS)
 
     add_new_products = Products(
         title=text.title,
         slug=generate_slug(text.title),
         description=text.description,
-        image_url=upload_result["secure_url"],
-        thumbnail_url=thumbnail_info["cloudinary_thumbnail_url"],
+        image_url=ingested_image["image_url"],
+        thumbnail_url=ingested_image["thumbnail_url"],
+        variant_urls=ingested_image["variant_urls"] or None,
         price=text.price,
         is_for_sale=text.is_for_sale,
         dimensions=text.dimensions,
-        resolution=text.resolution,
-        file_size_mb=text.file_size_mb,
-        file_format=text.file_format
+        resolution=text.resolution or ingested_image["resolution"],
+        file_size_mb=text.file_size_mb or ingested_image["file_size_mb"],
+        file_format=text.file_format or ingested_image["file_format"]
     )
 
     db.add(add_new_products)
     db.commit()
     db.refresh(add_new_products)
+    invalidate_products()
 
     return add_new_products
 
 @products_router.post("/add-photos-file", response_model=ProductsData)
-async def add_new_photos_via_file_upload(title: str = Form(...), description: Optional[str] = Form(None), price: float = Form(...), is_for_sale: bool = Form(True), image_file: UploadFile = File(...), dimensions : Optional[str] = Form(None), db: Session = Depends(get_db)):
+async def add_new_photos_via_file_upload(title: str = Form(...), description: Optional[str] = Form(None), price: float = Form(...), is_for_sale: bool = Form(True), image_file: UploadFile = File(...), dimensions : Optional[str] = Form(None), defer: bool = False, db: Session = Depends(get_db)):
     add_info_query = db.query(Products).filter(Products.title == title).first()
 
     if add_info_query:
@@ -64,23 +94,38 @@ async def add_new_photos_via_file_upload(title: str = Form(...), description: Op
     if db.query(Products).filter(Products.slug == generate_slug(title)).first():
         raise HTTPException(status_code=400, detail="Slug already exists. Please change the title.")
     
-    saved_image_file = save_upload_file(image_file)
-    saved_thumbnail_file = create_thumbnail(image_path=saved_image_file["local_path"])
+    if defer:
+        job = await enqueue_upload_job(db, "product", [image_file], lambda staged_files: {
+            **staged_files[0],
+            "title": title,
+            "description": description,
+            "price": price,
+            "is_for_sale": is_for_sale,
+            "dimensions": dimensions,
+        })
+        return job_accepted(job)
+
+    ingested_image = await ingest_image(db, upload_file=image_file, variants=IMAGE_VARIANTS)
 
     add_new_products = Products(
         title=title,
         slug=generate_slug(title),
         description=description,
-        image_url=saved_image_file["cloudinary_url"],
-        thumbnail_url=saved_thumbnail_file["cloudinary_thumbnail_url"],
+        image_url=ingested_image["image_url"],
+        thumbnail_url=ingested_image["thumbnail_url"],
+        variant_urls=ingested_image["variant_urls"] or None,
         dimensions=dimensions,
         price=price,
-        is_for_sale=is_for_sale
+        is_for_sale=is_for_sale,
+        resolution=ingested_image["resolution"],
+        file_size_mb=ingested_image["file_size_mb"],
+        file_format=ingested_image["file_format"]
     )
 
     db.add(add_new_products)
     db.commit()
     db.refresh(add_new_products)
+    invalidate_products()
 
     return add_new_products
 
@@ -110,6 +155,7 @@ async def add_photo_metafield(product_id: Optional[int]= None, product_title: Op
 
     db.commit()
     db.refresh(photo_query)
+    invalidate_products(photo_query.slug)
 
     return photo_query
 
@@ -152,17 +198,28 @@ async def edit_photo_entries(update_data: EditProductsData, product_id: Optional
 
     db.commit()
     db.refresh(edit_table_query)
+    invalidate_products(edit_table_query.slug)
 
     return edit_table_query
 
+def load_catalog(db: Session) -> list:
+    products = db.query(Products).order_by(Products.id).all()
+    return [ProductsData.model_validate(product, from_attributes=True).model_dump() for product in products]
+
 @products_router.get("/view-photos-table", response_model=List[ProductsData])
-async def view_photos_table(db: Session = Depends(get_db)):
-    products_table_query = db.query(Products).all()
+async def view_photos_table(request: Request, response: Response, cursor: Optional[int] = None, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), fields: Optional[str] = None, db: Session = Depends(get_db)):
+    if cursor is None and limit is None and not fields:
+        catalog = catalog_cache.get(lambda: load_catalog(db))
+        if not catalog.data:
+            raise HTTPException(status_code=400, detail="Products table cannot be found")
+        return snapshot_response(request, catalog)
 
-    if not products_table_query:
+    products_table_query, next_cursor = fetch_table_page(db, Products, cursor, limit, fields)
+
+    if not products_table_query and cursor is None:
           raise HTTPException(status_code=400, detail="Products table cannot be found")
     
-    return products_table_query
+    return page_response(products_table_query, next_cursor, response, fields)
 
 
 @products_router.get("/view-photos-table/{product}", response_model=List[ProductsData])
@@ -180,6 +237,51 @@ async def view_specific_artwork(product_id: Optional[int]= None, product_title:
     return products_table_query
 
 
+@products_router.get("/search", response_model=List[ProductsData])
+async def search_products(q: str = Query(..., min_length=1), limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), offset: int = Query(0, ge=0), db: Session = Depends(get_db)):
+    prefix_query = build_prefix_tsquery(q)
+    if not prefix_query:
+        return []
+
+    ts_query = func.to_tsquery("english", prefix_query)
+    rank = func.ts_rank_cd(Products.search_vector, ts_query)
+
+    return (
+        db.query(Products)
+        .filter(Products.search_vector.op("@@")(ts_query))
+        .order_by(rank.desc(), Products.id)
+        .offset(offset)
+        .limit(limit)
+        .all()
+    )
+
+@products_router.get("/batch", response_model=List[ProductsData])
+async def view_products_batch(ids: str = Query(..., description="Comma separated product IDs"), db: Session = Depends(get_db)):
+    try:
+        product_ids = list(dict.fromkeys(int(product_id) for product_id in ids.split(",") if product_id.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma separated list of product IDs")
+
+    if len(product_ids) > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"A maximum of {MAX_PAGE_SIZE} products can be fetched at once")
+
+    products = get_products_by_ids(db, product_ids)
+    return [products[product_id] for product_id in product_ids if product_id in products]
+
+def load_product_by_slug(db: Session, slug: str):
+    product = db.query(Products).filter(Products.slug == slug).first()
+    if not product:
+        return None
+    return ProductsData.model_validate(product, from_attributes=True).model_dump()
+
+@products_router.get("/by-slug/{slug}", response_model=ProductsData)
+async def view_product_by_slug(slug: str, db: Session = Depends(get_db)):
+    product = product_slug_cache.get(slug, lambda: load_product_by_slug(db, slug))
+    if not product:
+        raise HTTPException(status_code=404, detail="This artwork cannot be found in the Products table")
+
+    return product
+
 @products_router.delete("/delete-a-photo/{product}")
 async def delete_a_photo(product_id: Optional[int]= None, product_title: Optional[str]= None, db: Session = Depends(get_db)):
     if product_id:
@@ -196,48 +298,43 @@ async def delete_a_photo(product_id: Optional[int]= None, product_title: Optiona
     if linked_order_item:
         raise HTTPException(status_code=400, detail="Cannot delete this photo because it is linked to existing orders.")
     
-    try:
-        if delete_photo_query.image_url:
-            public_id = delete_photo_query.image_url.split("/")[-1].split(".")[0]
-            cloudinary.uploader.destroy(f"uploads/{public_id}", resource_type="image")
-
-        if hasattr(delete_photo_query, "thumbnail_url") and delete_photo_query.thumbnail_url:
-            thumb_id = delete_photo_query.thumbnail_url.split("/")[-1].split(".")[0]
-            cloudinary.uploader.destroy(f"thumbnails/{thumb_id}", resource_type="image")
-
-    except Exception as e:
-        print("Cloudinary delete error:", e)
+    media_urls = []
+    if release_media_asset(db, delete_photo_query.image_url, "product"):
+        media_urls = [delete_photo_query.image_url, delete_photo_query.thumbnail_url, *(delete_photo_query.variant_urls or {}).values()]
 
+    slug = delete_photo_query.slug
     db.delete(delete_photo_query)
     db.commit()
-    return {"detail": f"Artwork {delete_photo_query.title} has been deleted from the table"}
+    invalidate_products(slug)
+
+    media_result = await delete_media_urls(media_urls)
+    return {"detail": f"Artwork {delete_photo_query.title} has been deleted from the table", "media": media_result}
 
 @products_router.delete("/delete-all-photos")
 async def delete_all_photos(db: Session = Depends(get_db)):
-    all_photos = db.query(Products).all()
-
-    for photos in all_photos:
-        linked_order_item = db.query(OrderItem).filter(OrderItem.product_id == photos.id).first()
-        if linked_order_item:
-            raise HTTPException(status_code=400, detail="Cannot delete this photo because it is linked to existing orders.")
-        try:
-            if photos.image_url:
-                public_id = photos.image_url.split("/")[-1].split(".")[0]
-                cloudinary.uploader.destroy(f"uploads/{public_id}", resource_type="image")
-
-            if hasattr(photos, "thumbnail_url") and photos.thumbnail_url:
-                thumb_id = photos.thumbnail_url.split("/")[-1].split(".")[0]
-                cloudinary.uploader.destroy(f"thumbnails/{thumb_id}", resource_type="image")
-
-        except Exception as e:
-            print("Cloudinary delete error:", e)
+    linked_product_ids = [product_id for (product_id,) in db.query(OrderItem.product_id).filter(OrderItem.product_id.isnot(None)).distinct()]
+    if linked_product_ids:
+        raise HTTPException(status_code=400, detail=f"Cannot delete photos {sorted(linked_product_ids)} because they are linked to existing orders.")
+
+    all_photos = db.query(Products.image_url, Products.thumbnail_url, Products.variant_urls).all()
+    releasable = release_media_assets(db, [photo.image_url for photo in all_photos], "product")
+    media_urls = [
+        url
+        for photo in all_photos if photo.image_url in releasable
+        for url in (photo.image_url, photo.thumbnail_url, *(photo.variant_urls or {}).values())
+    ]
 
-        db.delete(photos) 
+    db.query(Products).delete(synchronize_session=False)
     db.commit()
-    return {"detail": "All members have been deleted :("}
+    invalidate_products()
+
+    # Rows are gone first, so a failed remote delete leaves an orphaned file
+    # rather than a product pointing at a missing image
+    media_result = await delete_media_urls(media_urls)
+    return {"detail": "All members have been deleted :(", "media": media_result}
 
 @portfolio_router.post("/add-portfolio", response_model=PortfolioResponse)
-async def add_new_portfolio(title: str = Form(...), category: str = Form(...), files: List[UploadFile] = File(...), db: Session = Depends(get_db)):
+async def add_new_portfolio(title: str = Form(...), category: str = Form(...), files: List[UploadFile] = File(...), defer: bool = False, db: Session = Depends(get_db)):
     if db.query(Portfolio).filter(Portfolio.title == title).first():
         raise HTTPException(status_code=400, detail="Portfolio with this title already exists.")
 
@@ -254,27 +351,58 @@ async def add_new_portfolio(title: str = Form(...), category: str = Form(...), f
         )
 
     portfolio = Portfolio(title=title, slug=slug, category=category_enum)
-    db.add(portfolio)
-    db.commit()
-    db.refresh(portfolio)
 
-    image_entries = []
-    for file in files:
-        saved_file = save_upload_file(file)
-        upload_result = cloudinary.uploader.upload(
-            saved_file["local_path"],
-            folder=f"portfolio/{category_enum}/{slug}",
-            public_id=file.filename.rsplit('.', 1)[0],
-            resource_type="image",
-            overwrite=True
-        )
+    if defer:
+        # Hidden from the listings until the job has stored every image
+        portfolio.is_published = False
+
+        def portfolio_payload(staged_files):
+            db.add(portfolio)
+            db.flush()
+            return {
+                "portfolio_id": portfolio.id,
+                "folder": f"portfolio/{category_enum}/{slug}",
+                "files": [
+                    {**staged_file, "public_id": file.filename.rsplit('.', 1)[0]}
+                    for file, staged_file in zip(files, staged_files)
+                ],
+            }
 
-        thumbnail_info = create_thumbnail(image_path=saved_file["local_path"], folder = "portfolio_thumbnail")
+        job = await enqueue_upload_job(db, "portfolio", files, portfolio_payload)
+        return job_accepted(job)
+
+    upload_limit = asyncio.Semaphore(PORTFOLIO_UPLOAD_CONCURRENCY)
+
+    async def ingest_portfolio_file(file: UploadFile):
+        async with upload_limit:
+            return await ingest_image(
+                db,
+                upload_file=file,
+                kind="portfolio",
+                folder=f"portfolio/{category_enum}/{slug}",
+                thumbnail_folder="portfolio_thumbnail",
+                public_id=file.filename.rsplit('.', 1)[0],
+            )
+
+    # Let every file finish before failing, so no upload is still using the session
+    ingested_images = await asyncio.gather(*(ingest_portfolio_file(file) for file in files), return_exceptions=True)
+    failure = next((result for result in ingested_images if isinstance(result, BaseException)), None)
+    if failure:
+        # Nothing is committed yet, so the rollback gives back every asset this
+        # request claimed, and the files it uploaded go with the ones nobody else uses
+        db.rollback()
+        raise failure
+
+    # Created only once every file is stored, so a failed upload leaves no empty portfolio
+    db.add(portfolio)
+    db.flush()
 
+    image_entries = []
+    for ingested_image in ingested_images:
         portfolio_image = PortfolioImages(
             portfolio_id=portfolio.id,
-            image_url=upload_result["secure_url"],
-            thumbnail_url=thumbnail_info["cloudinary_thumbnail_url"]
+            image_url=ingested_image["image_url"],
+            thumbnail_url=ingested_image["thumbnail_url"]
         )
         db.add(portfolio_image)
         image_entries.append(portfolio_image)
@@ -283,22 +411,46 @@ async def add_new_portfolio(title: str = Form(...), category: str = Form(...), f
     for img in image_entries:
         db.refresh(img)
 
-    portfolio.images = image_entries
+    invalidate_portfolios()
     return portfolio
 
+def load_portfolios(db: Session) -> list:
+    portfolios = db.query(Portfolio).options(selectinload(Portfolio.images)).filter(Portfolio.is_published.is_(True)).order_by(Portfolio.id).all()
+    return [PortfolioResponse.model_validate(portfolio, from_attributes=True).model_dump() for portfolio in portfolios]
+
 @portfolio_router.get("/view-all-portfolios", response_model=List[PortfolioResponse])
-async def get_all_portfolios(db: Session = Depends(get_db)):
-    portfolios = db.query(Portfolio).all()
-    for portfolio in portfolios:
-        portfolio.images = db.query(PortfolioImages).filter(PortfolioImages.portfolio_id == portfolio.id).all()
-    return portfolios
+async def get_all_portfolios(request: Request, db: Session = Depends(get_db)):
+    return snapshot_response(request, portfolio_cache.get(lambda: load_portfolios(db)))
+
+def load_portfolio_category_page(db: Session, category: PortfolioType, cursor: Optional[str], limit: int):
+    query = db.query(Portfolio).options(selectinload(Portfolio.images)).filter(Portfolio.category == category, Portfolio.is_published.is_(True))
+    if cursor:
+        created_at, portfolio_id = decode_cursor(cursor)
+        query = query.filter(tuple_(Portfolio.created_at, Portfolio.id) > tuple_(created_at, portfolio_id))
+
+    portfolios = query.order_by(Portfolio.created_at, Portfolio.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(portfolios) > limit:
+        portfolios = portfolios[:limit]
+        next_cursor = encode_cursor(portfolios[-1].created_at, portfolios[-1].id)
+
+    data = [PortfolioResponse.model_validate(portfolio, from_attributes=True).model_dump() for portfolio in portfolios]
+    return build_snapshot(data), next_cursor
+
+@portfolio_router.get("/portfolios", response_model=List[PortfolioResponse])
+async def get_portfolios_by_category(request: Request, category: PortfolioType, cursor: Optional[str] = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    snapshot, next_cursor = portfolio_category_cache.get(
+        (category, cursor, limit),
+        lambda: load_portfolio_category_page(db, category, cursor, limit),
+    )
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return snapshot_response(request, snapshot, headers)
 
 @portfolio_router.get("/view-a-portfolio/{portfolio_id}", response_model=PortfolioResponse)
 async def get_portfolio(portfolio_id: int, db: Session = Depends(get_db)):
-    portfolio = db.query(Portfolio).filter(Portfolio.id == portfolio_id).first()
+    portfolio = db.query(Portfolio).options(selectinload(Portfolio.images)).filter(Portfolio.id == portfolio_id, Portfolio.is_published.is_(True)).first()
     if not portfolio:
         raise HTTPException(status_code=404, detail="Portfolio not found")
-    portfolio.images = db.query(PortfolioImages).filter(PortfolioImages.portfolio_id == portfolio.id).all()
     return portfolio
 
 @portfolio_router.delete("/delete-portfolio/{portfolio_id}")
@@ -307,63 +459,46 @@ async def delete_portfolio(portfolio_id: int, db: Session = Depends(get_db)):
     if not portfolio:
         raise HTTPException(status_code=404, detail="Portfolio not found")
     
-    for img in portfolio.images:
-        try:
-            if img.image_url:
-                path = img.image_url.split("/upload/")[-1]
-                public_id_with_ext = path.split("/", 1)[1] 
-                public_id_with_ext = unquote(public_id_with_ext)  
-                public_id = public_id_with_ext.rsplit(".", 1)[0] 
-                cloudinary.uploader.destroy(public_id, resource_type="image")
-
-            if img.thumbnail_url:
-                thumb_id = img.thumbnail_url.split("/")[-1].split(".")[0]
-                cloudinary.uploader.destroy(f"portfolio_thumbnail/{thumb_id}", resource_type="image")
-
-        except Exception as e:
-            print("Cloudinary deletion error:", e)
+    images = db.query(PortfolioImages.image_url, PortfolioImages.thumbnail_url).filter(PortfolioImages.portfolio_id == portfolio.id).all()
+    releasable = release_media_assets(db, [img.image_url for img in images], "portfolio")
+    media_urls = [url for img in images if img.image_url in releasable for url in (img.image_url, img.thumbnail_url)]
 
     db.query(PortfolioImages).filter(PortfolioImages.portfolio_id == portfolio.id).delete()
     db.delete(portfolio)
     db.commit()
+    invalidate_portfolios()
 
-    return {"message": "Portfolio deleted successfully"}
+    media_result = await delete_media_urls(media_urls)
+    return {"message": "Portfolio deleted successfully", "media": media_result}
 
 @portfolio_router.delete("/delete-all-portfolios")
 async def delete_all_portfolios(db: Session = Depends(get_db)):
-    portfolios = db.query(Portfolio).all()
-
-    for portfolio in portfolios:
-        for img in portfolio.images:
-            try:
-                if img.image_url:
-                    path = img.image_url.split("/upload/")[-1]
-                    public_id_with_ext = path.split("/", 1)[1] 
-                    public_id_with_ext = unquote(public_id_with_ext)  
-                    public_id = public_id_with_ext.rsplit(".", 1)[0] 
-                    cloudinary.uploader.destroy(public_id, resource_type="image")
-
-                if img.thumbnail_url:
-                    thumb_id = img.thumbnail_url.split("/")[-1].split(".")[0]
-                    cloudinary.uploader.destroy(f"portfolio_thumbnail/{thumb_id}", resource_type="image")
-            except Exception as e:
-                print("Cloudinary deletion error:", e)
-
-        db.query(PortfolioImages).filter(PortfolioImages.portfolio_id == portfolio.id).delete(synchronize_session=False)
-        db.delete(portfolio)
+    images = db.query(PortfolioImages.image_url, PortfolioImages.thumbnail_url).all()
+    releasable = release_media_assets(db, [img.image_url for img in images], "portfolio")
+    media_urls = [url for img in images if img.image_url in releasable for url in (img.image_url, img.thumbnail_url)]
+
+    db.query(PortfolioImages).delete(synchronize_session=False)
+    db.query(Portfolio).delete(synchronize_session=False)
     db.commit()
-    return {"message": "All portfolios deleted successfully"}
+    invalidate_portfolios()
+
+    media_result = await delete_media_urls(media_urls)
+    return {"message": "All portfolios deleted successfully", "media": media_result}
 
 @poem_router.post("/add-pic-and-poem-of-the-week")
 async def add_pic_of_the_week(upload_file: UploadFile, title: str = Form(...), poem: str = Form(...), db: Session = Depends(get_db)):
     try:
         image_info = await save_pic_of_week(upload_file) 
-        cloud_url = upload_pic_of_week(image_path=image_info["local_path"])
+        try:
+            cloud_url = await run_image_task(upload_pic_of_week, image_path=image_info["local_path"])
+        finally:
+            scratch_storage.release(image_info["local_path"])
 
         pic_record = PicOfTheWeek(title=title, image_url=cloud_url, poem=poem)
         db.add(pic_record)
         db.commit()
         db.refresh(pic_record)
+        invalidate_pics_of_week()
 
         return {
             "message": "Pic of the Week added successfully",
@@ -374,17 +509,39 @@ async def add_pic_of_the_week(upload_file: UploadFile, title: str = Form(...), p
                 "poem": pic_record.poem
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
-@poem_router.get("/pic-of-the-week", response_model=List[PicOfTheWeekResponse])
-async def get_all_pics_of_the_week(db: Session = Depends(get_db)):
-    pics = db.query(PicOfTheWeek).all()
+def load_pics_of_the_week(db: Session) -> list:
+    pics = db.query(PicOfTheWeek).order_by(PicOfTheWeek.id).all()
     return [
         {"id": pic.id, "image_url": pic.image_url, "poem": pic.poem}
         for pic in pics
     ]
 
+def load_current_pic_of_the_week(db: Session):
+    pic = db.query(PicOfTheWeek).order_by(PicOfTheWeek.created_at.desc(), PicOfTheWeek.id.desc()).first()
+    if not pic:
+        return None
+    return {"id": pic.id, "image_url": pic.image_url, "poem": pic.poem}
+
+@poem_router.get("/pic-of-the-week", response_model=List[PicOfTheWeekResponse])
+async def get_all_pics_of_the_week(request: Request, response: Response, cursor: Optional[int] = None, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    if cursor is None and limit is None:
+        return snapshot_response(request, pic_of_week_cache.get(lambda: load_pics_of_the_week(db)))
+
+    pics, next_cursor = fetch_table_page(db, PicOfTheWeek, cursor, limit)
+    return page_response(pics, next_cursor, response)
+
+@poem_router.get("/pic-of-the-week/current", response_model=PicOfTheWeekResponse)
+async def get_current_pic_of_the_week(request: Request, db: Session = Depends(get_db)):
+    current = current_pic_of_week_cache.get(lambda: load_current_pic_of_the_week(db))
+    if current.data is None:
+        raise HTTPException(status_code=404, detail="Pic of the Week not found")
+    return snapshot_response(request, current)
+
 @poem_router.get("/pic-of-the-week/{pic_id}", response_model=PicOfTheWeekResponse)
 async def get_pic_of_the_week(pic_id: int, db: Session = Depends(get_db)):
     pic = db.query(PicOfTheWeek).filter(PicOfTheWeek.id == pic_id).first()
@@ -398,31 +555,43 @@ async def delete_pic_of_the_week(pic_id: int, db: Session = Depends(get_db)):
     if not pic_record:
         raise HTTPException(status_code=404, detail="Pic of the Week not found")
 
-    try:
-        public_id = pic_record.image_url.split("/")[-1].split(".")[0]
-        cloudinary.uploader.destroy(f"PicOfWeek/{public_id}", resource_type="image")
-    except Exception:
-        pass 
-
+    image_url = pic_record.image_url
     db.delete(pic_record)
     db.commit()
-    return {"message": "Pic of the Week deleted successfully"}
+    invalidate_pics_of_week()
+
+    media_result = await delete_media_urls([image_url])
+    return {"message": "Pic of the Week deleted successfully", "media": media_result}
 
 @poem_router.delete("/delete-all-pic-of-the-week")
 async def delete_all_pic_of_the_week(db: Session = Depends(get_db)):
-    pics = db.query(PicOfTheWeek).all()
-
-    for pic in pics:
-        try:
-            if pic.image_url:
-                public_id = pic.image_url.split("/")[-1].split(".")[0]
-                cloudinary.uploader.destroy(f"PicOfWeek/{public_id}", resource_type="image")
-        except Exception as e:
-            print("Cloudinary deletion error:", e)
+    media_urls = [image_url for (image_url,) in db.query(PicOfTheWeek.image_url)]
 
-        db.delete(pic)
+    db.query(PicOfTheWeek).delete(synchronize_session=False)
     db.commit()
-    return {"message": "All Pic of the Week entries deleted successfully"}
+    invalidate_pics_of_week()
+
+    media_result = await delete_media_urls(media_urls)
+    return {"message": "All Pic of the Week entries deleted successfully", "media": media_result}
+
+@jobs_router.get("/jobs/{job_id}", response_model=ImageJobResponse)
+async def get_image_job(job_id: int, db: Session = Depends(get_db)):
+    job = db.query(ImageJobs).filter(ImageJobs.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@admin_router.get("/scratch-usage")
+async def view_scratch_usage():
+    return scratch_storage.usage()
+
+@admin_router.get("/email-outbox-stats")
+async def view_email_outbox_stats(db: Session = Depends(get_db)):
+    return email_outbox_stats(db)
+
+@admin_router.get("/cache-stats")
+async def view_cache_stats():
+    return cache_stats()
 
 @admin_router.post("/create-admin")
 def create_admin(admin: AdminCreate, db: Session = Depends(get_db)):
@@ -1,16 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, Form, File, UploadFile, Query, Request
+from fastapi import APIRouter, Depends, HTTPException, Form, File, UploadFile, Query, Request, Response, Header
 from datetime import datetime
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import func, insert
 import os
+import json
 import smtplib
 from dotenv import load_dotenv
 import uuid
 import logging
 import stripe
-from tables import get_db, Products, CheckoutInfo, Shipping, ShippingInfo, Orders, OrderItem
-from schemas import CreateOrder, OrderResponse, OrderItemResponse, CheckoutInfoResponse, ProductType, ShippingData, CreateShippingInfo, ShippingInfoResponse, StatusType, PaymentIntentRequest, PaymentIntentResponse, PaymentVerificationRequest, ShippingData, CartItem
-from func import calculate_order_shipping_and_tax, calculate_checkout_total_for_order, send_order_confirmation_email, send_order_status_email, calculate_order_weight, generate_signed_cloudinary_url
+from tables import get_db, CheckoutInfo, Shipping, ShippingInfo, Orders, OrderItem
+from schemas import CreateOrder, OrderResponse, OrderItemResponse, CheckoutInfoResponse, ProductType, ShippingData, CreateShippingInfo, ShippingInfoResponse, StatusType, PaymentIntentRequest, PaymentIntentResponse, PaymentVerificationRequest, ShippingData, CartItem, JobStatusType
+from func import calculate_order_shipping_and_tax, calculate_checkout_total_for_order, calculate_order_weight, generate_signed_cloudinary_url, fetch_table_page, page_response, resolve_products, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from jobs import enqueue_email, requeue_email, record_stripe_event, STRIPE_EVENT_HANDLERS
+from idempotency import request_fingerprint, begin_idempotent_request, complete_idempotent_request, release_idempotent_request
 # from func import reset_primary_key_sequence
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
@@ -33,15 +36,27 @@ shipping_router = APIRouter()
 load_dotenv()
 
 @orders_router.post("/order", response_model=OrderResponse)
-async def create_order( order_data: CreateOrder, shipping_type: str = "standard", shipping: Optional[ShippingData] = None, db: Session = Depends(get_db)):
+async def create_order( order_data: CreateOrder, shipping_type: str = "standard", shipping: Optional[ShippingData] = None, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), db: Session = Depends(get_db)):
+    fingerprint = request_fingerprint({"order": order_data, "shipping_type": shipping_type, "shipping": shipping})
+    replayed = begin_idempotent_request(db, "order", idempotency_key, fingerprint)
+    if replayed:
+        return replayed
+
+    try:
+        return place_order(order_data, shipping_type, shipping, idempotency_key, db)
+    except Exception:
+        release_idempotent_request(db, "order", idempotency_key)
+        raise
+
+def place_order(order_data: CreateOrder, shipping_type: str, shipping: Optional[ShippingData], idempotency_key: Optional[str], db: Session) -> OrderResponse:
     if not order_data.items:
         raise HTTPException(status_code=400, detail="No items provided for order")
 
+    products = resolve_products(db, [item.product_id for item in order_data.items])
+
     merged_items = {}
     for item in order_data.items:
-        product = db.query(Products).filter(Products.id == item.product_id).first()
-        if not product:
-            raise HTTPException(status_code=404, detail=f"Product {item.product_id} not found")
+        product = products[item.product_id]
 
         key = (item.product_id, item.product_type.value.lower())
         if key in merged_items:
@@ -92,99 +107,95 @@ async def create_order( order_data: CreateOrder, shipping_type: str = "standard"
         order_total=float(order_total),
         created_at=datetime.utcnow()
     )
-    db.add(new_order)
-    db.commit()
-    db.refresh(new_order)
 
-    new_checkout = CheckoutInfo(
-        order_id=new_order.id,
-        customer_name=order_data.customer_name,
-        email=order_data.customer_email,
-        phone_number=order_data.phone_number,
-        amount_to_be_paid=order_total,
-        amount_paid=order_total,
-        currency="GBP",
-        shipping_fee=float(shipping_fee),
-        tax_amount=float(tax_amount),
-        payment_status=StatusType.ordered.value,
-        transaction_id=str(uuid.uuid4()),
-    )
-    db.add(new_checkout)
-    db.commit()
-    db.refresh(new_checkout)
-
-    if shipping_entry:
-        shipping_entry.order_id = new_order.id
-        db.add(shipping_entry)
-        db.commit()
-        db.refresh(shipping_entry)
+    # Everything below is one unit of work: flush for the order id, commit once
+    try:
+        db.add(new_order)
+        db.flush()
 
-    for item in merged_items.values():
-        order_item = OrderItem(
+        db.add(CheckoutInfo(
             order_id=new_order.id,
-            product_id=item["product_id"],
-            product_type=item["product_type"],
-            quantity=item["quantity"],
-            price_at_purchase=float(item["price"] * item["quantity"])
-        )
-        db.add(order_item)
-    db.commit()
-    db.refresh(new_order)
-
-    send_order_confirmation_email(new_order, db)
-
-    return OrderResponse(
-        id=new_order.id,
-        customer_name=new_order.customer_name,
-        customer_email=new_order.customer_email,
-        phone_number=new_order.phone_number,
-        status=new_order.status,
-        created_at=new_order.created_at,
-        items=[
-            OrderItemResponse(
-                product_id=item["product_id"],
-                name=item["name"],
-                price=float(item["price"]),
-                quantity=item["quantity"],
-                product_type=item["product_type"]
-            )
+            customer_name=order_data.customer_name,
+            email=order_data.customer_email,
+            phone_number=order_data.phone_number,
+            amount_to_be_paid=order_total,
+            amount_paid=order_total,
+            currency="GBP",
+            shipping_fee=float(shipping_fee),
+            tax_amount=float(tax_amount),
+            payment_status=StatusType.ordered.value,
+            transaction_id=str(uuid.uuid4()),
+        ))
+
+        if shipping_entry:
+            shipping_entry.order_id = new_order.id
+            db.add(shipping_entry)
+
+        db.execute(insert(OrderItem), [
+            {
+                "order_id": new_order.id,
+                "product_id": item["product_id"],
+                "product_type": item["product_type"],
+                "quantity": item["quantity"],
+                "price_at_purchase": float(item["price"] * item["quantity"]),
+            }
             for item in merged_items.values()
-        ],
-        order_total=float(order_total) 
-    )
+        ])
+        enqueue_email(db, "order_confirmation", new_order.id)
+
+        order_response = OrderResponse(
+            id=new_order.id,
+            customer_name=new_order.customer_name,
+            customer_email=new_order.customer_email,
+            phone_number=new_order.phone_number,
+            status=new_order.status,
+            created_at=new_order.created_at,
+            items=[
+                OrderItemResponse(
+                    product_id=item["product_id"],
+                    name=item["name"],
+                    price=float(item["price"]),
+                    quantity=item["quantity"],
+                    product_type=item["product_type"]
+                )
+                for item in merged_items.values()
+            ],
+            order_total=float(order_total) 
+        )
+        complete_idempotent_request(db, "order", idempotency_key, order_response)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return order_response
 
 @email_router.post("/send-order-confirmation/{order_id}")
-async def order_confirmation_via_email(order_id:int, db: Session = Depends(get_db)):
+async def order_confirmation_via_email(order_id:int, resend: bool = False, db: Session = Depends(get_db)):
     order = db.query(Orders).filter(Orders.id == order_id).first()
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
 
-    try:
-        send_order_confirmation_email(order, db)
-    except Exception as e:
-        logger.error(f"Failed to send email for order_id {order_id}: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
+    email = enqueue_email(db, "order_confirmation", order.id)
+    if email.status == JobStatusType.failed or (resend and email.status == JobStatusType.succeeded):
+        requeue_email(email)
+    db.commit()
     
-    return {"message": "Order confirmation email sent successfully"}
+    return {"message": "Order confirmation email queued", "email_id": email.id, "status": email.status.value}
 
 @email_router.post("/send-order-update/{order_id}")
-async def send_order_status_via_email(order_id:int, db: Session = Depends(get_db)):
+async def send_order_status_via_email(order_id:int, resend: bool = False, db: Session = Depends(get_db)):
     order = db.query(Orders).filter(Orders.id == order_id).first()
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    try:
-        order.status = "shipped"
-        db.commit()
-        db.refresh(order)
-
-        send_order_status_email(order, db)
-
-    except Exception as e:
-        logger.error(f"Failed to send email for order_id {order_id}: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
+    order.status = "shipped"
+    email = enqueue_email(db, "order_status", order.id, dedupe_key=f"order_status:{order.id}:shipped")
+    if email.status == JobStatusType.failed or (resend and email.status == JobStatusType.succeeded):
+        requeue_email(email)
+    db.commit()
     
-    return {"message": "Order Status email sent successfully"}
+    return {"message": "Order Status email queued", "email_id": email.id, "status": email.status.value}
     
 @checkout_router.get("/calculate-total", response_model=CheckoutInfoResponse)
 async def calculate_checkout_endpoint(order_id: Optional[int] = None, customer_name: Optional[str] = None, db: Session = Depends(get_db)):
@@ -488,7 +499,18 @@ async def calculate_checkout_endpoint(order_id: Optional[int] = None, customer_n
 #     )
 
 @payment_router.post("/payment/create-intent", response_model=PaymentIntentResponse)
-async def create_payment_intent(data: PaymentIntentRequest, db: Session = Depends(get_db)):
+async def create_payment_intent(data: PaymentIntentRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), db: Session = Depends(get_db)):
+    replayed = begin_idempotent_request(db, "payment_intent", idempotency_key, request_fingerprint(data))
+    if replayed:
+        return replayed
+
+    try:
+        return start_payment_intent(data, idempotency_key, db)
+    except Exception:
+        release_idempotent_request(db, "payment_intent", idempotency_key)
+        raise
+
+def start_payment_intent(data: PaymentIntentRequest, idempotency_key: Optional[str], db: Session) -> PaymentIntentResponse:
     stripe.api_key = os.getenv("STRIPE_SECRET_KEY1")
 
     subtotal = sum(item.price * item.quantity for item in data.items)
@@ -521,10 +543,7 @@ async def create_payment_intent(data: PaymentIntentRequest, db: Session = Depend
 
     order_total = subtotal + float(shipping_fee) + float(tax)
 
-    for item in data.items:
-        product = db.query(Products).filter_by(id=item.product_id).first()
-        if not product:
-            raise HTTPException(status_code=404, detail=f"Product {item.product_id} not found")
+    resolve_products(db, [item.product_id for item in data.items])
 
     metadata = {
         "customer_name": data.customer.name,
@@ -545,11 +564,13 @@ async def create_payment_intent(data: PaymentIntentRequest, db: Session = Depend
         })
 
     try:
+        # Stripe dedupes on its own key too, in case our stored claim was released
         intent = stripe.PaymentIntent.create(
             amount=int(order_total * 100),
             currency="GBP",
             metadata=metadata,
-            shipping=shipping_payload 
+            shipping=shipping_payload,
+            idempotency_key=f"payment-intent-{idempotency_key}" if idempotency_key else None,
         )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Stripe error: {str(e)}")
@@ -580,14 +601,16 @@ async def create_payment_intent(data: PaymentIntentRequest, db: Session = Depend
             checkout_info_id=checkout_info.id  # ✅ Link to checkout
         )
         db.add(order_item)
-    db.commit()
-    db.refresh(checkout_info)
 
-    return PaymentIntentResponse(
+    payment_response = PaymentIntentResponse(
         client_secret=intent.client_secret,
         amount=order_total,
         currency="GBP"
     )
+    complete_idempotent_request(db, "payment_intent", idempotency_key, payment_response)
+    db.commit()
+
+    return payment_response
 
 # @payment_router.post("/payment/webhook")
 # async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
@@ -689,83 +712,15 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
         logger.error(f"Webhook error: {str(e)}")
         return JSONResponse(status_code=400, content={"error": str(e)})
 
-    if event["type"] == "payment_intent.succeeded":
-        intent = event["data"]["object"]
-        transaction_id = intent["id"]
-        metadata = intent.get("metadata", {})
-
-        checkout_info = db.query(CheckoutInfo).filter(
-            CheckoutInfo.transaction_id == transaction_id
-        ).first()
-        
-        if not checkout_info:
-            logger.warning(f"Checkout not found for transaction: {transaction_id}")
-            return {"status": "success"}
-
-        try:
-            checkout_info.payment_status = StatusType.succeeded.value
-            checkout_info.amount_paid = checkout_info.amount_to_be_paid
-
-            has_physical = any(
-                getattr(item.product_type, "value", item.product_type) == ProductType.physical.value 
-                for item in checkout_info.items
-            )
-            order_status = StatusType.ordered if has_physical else StatusType.delivered
-
-            # Create Order
-            order = Orders(
-                customer_name=checkout_info.customer_name,
-                customer_email=checkout_info.email,
-                phone_number=checkout_info.phone_number,
-                status=order_status,
-                order_total=checkout_info.amount_to_be_paid,
-            )
-            db.add(order)
-            db.flush()
-
-            # Update order items
-            for item in checkout_info.items:
-                item.order_id = order.id
-            db.flush()
-
-            checkout_info.order_id = order.id
-
-            # Create Shipping from metadata (Order now exists!)
-            if metadata.get("has_physical") == "true":
-                shipping_record = Shipping(
-                    order_id=order.id,  # Valid order_id now!
-                    address_line1=metadata.get("shipping_address_line1", ""),
-                    address_line2=metadata.get("shipping_address_line2", ""),
-                    city=metadata.get("shipping_city", ""),
-                    state=metadata.get("shipping_state", ""),
-                    postal_code=metadata.get("shipping_postal_code", ""),
-                    country_code=metadata.get("shipping_country_code", ""),
-                    shipping_fee=float(metadata.get("shipping_fee", 0)),
-                    tax=float(metadata.get("shipping_tax", 0))
-                )
-                db.add(shipping_record)
-                logger.info(f"Shipping created for order {order.id}")
-
-            db.commit()
-            db.refresh(order)
-
-            send_order_confirmation_email(order, db)
-            logger.info(f"Order {order.id} created successfully")
-
-        except Exception as e:
-            db.rollback()
-            logger.error(f"Webhook error: {str(e)}")
-            return {"status": "success"}
-
-    elif event["type"] == "payment_intent.payment_failed":
-        intent = event["data"]["object"]
-        transaction_id = intent["id"]
-        checkout_info = db.query(CheckoutInfo).filter(
-            CheckoutInfo.transaction_id == transaction_id
-        ).first()
-        if checkout_info:
-            checkout_info.payment_status = StatusType.failed.value
-            db.commit()
+    # Stripe only needs to know the event is safely stored, the stripe-events
+    # workers create the order. Redeliveries hit the primary key and are dropped.
+    if event["type"] in STRIPE_EVENT_HANDLERS:
+        inserted = record_stripe_event(db, json.loads(payload))
+        # Ends the transaction on both paths, so the connection is back in the pool
+        # before the next webhook runs on the event loop
+        db.commit()
+        if not inserted:
+            logger.info(f"Duplicate Stripe event {event['id']} ignored")
 
     return {"status": "success"}
 
@@ -832,8 +787,26 @@ async def input_shipping_info(order_id: int, text: CreateShippingInfo, db: Sessi
     return shipping_info
 
 @orders_router.get("/view-orders",response_model=List[OrderResponse])
-async def view_orders_table(db: Session = Depends(get_db)):
-    orders = db.query(Orders).all()
+async def view_orders_table(response: Response, cursor: Optional[int] = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), status: Optional[StatusType] = None, created_from: Optional[datetime] = None, created_to: Optional[datetime] = None, customer_email: Optional[str] = None, db: Session = Depends(get_db)):
+    if created_from and created_to and created_from > created_to:
+        raise HTTPException(status_code=400, detail="created_from must be before created_to")
+
+    filters = []
+    if status:
+        filters.append(Orders.status == status)
+    if created_from:
+        filters.append(Orders.created_at >= created_from)
+    if created_to:
+        filters.append(Orders.created_at < created_to)
+    if customer_email:
+        filters.append(func.lower(Orders.customer_email) == customer_email.strip().lower())
+
+    # Items and their products come in two IN queries for the whole page, not per order
+    orders, next_cursor = fetch_table_page(
+        db, Orders, cursor, limit,
+        filters=filters,
+        options=[selectinload(Orders.items).selectinload(OrderItem.product)],
+    )
     order_responses = []
     for order in orders:
         items = [
@@ -857,7 +830,7 @@ async def view_orders_table(db: Session = Depends(get_db)):
             order_total=float(order.order_total)            
         ))
 
-    return order_responses
+    return page_response(order_responses, next_cursor, response)
 
 @shipping_router.get("/view-a-shipping-record/{order}")
 async def view_shipping_table(order_id: Optional[int] = None, shipping_id: Optional[int] = None, db: Session = Depends(get_db)):
@@ -874,12 +847,12 @@ async def view_shipping_table(order_id: Optional[int] = None, shipping_id: Optio
     return shipping
     
 @shipping_router.get("/view-shipping-table")
-async def view_shipping_table(db: Session = Depends(get_db)):
-    shipping = db.query(Shipping).all()
-    if not shipping:
+async def view_shipping_table(response: Response, cursor: Optional[int] = None, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), fields: Optional[str] = None, db: Session = Depends(get_db)):
+    shipping, next_cursor = fetch_table_page(db, Shipping, cursor, limit, fields)
+    if not shipping and cursor is None:
         raise HTTPException(status_code=404, detail="Shipping table cant be found")
     
-    return shipping
+    return page_response(shipping, next_cursor, response, fields)
 
 @shipping_router.get("/view-shipping-info-table/{order}")
 async def view_shipping_info_table(order_id:int, db: Session = Depends(get_db)):
@@ -890,9 +863,9 @@ async def view_shipping_info_table(order_id:int, db: Session = Depends(get_db)):
     return shipping_info
 
 @shipping_router.get("/view-shipping-info-table")
-async def view_shipping_table(db: Session = Depends(get_db)):
-    shipping_info = db.query(ShippingInfo).all()
-    if not shipping_info:
+async def view_shipping_table(response: Response, cursor: Optional[int] = None, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), fields: Optional[str] = None, db: Session = Depends(get_db)):
+    shipping_info, next_cursor = fetch_table_page(db, ShippingInfo, cursor, limit, fields)
+    if not shipping_info and cursor is None:
         raise HTTPException(status_code=404, detail="Shipping Info table can't be found")
     
-    return shipping_info
+    return page_response(shipping_info, next_cursor, response, fields)
@@ -0,0 +1,124 @@
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Feeds recorded Stripe events through the webhook with valid signatures, so the
+# ack path and the stripe-events workers can be load tested without Stripe.
+#
+#   python replay_stripe_events.py export events.jsonl
+#   python replay_stripe_events.py replay events.jsonl --url http://localhost:8000/payment/webhook --rate 200 --repeat 10 --fresh-ids
+
+def sign_payload(body: bytes, secret: str) -> str:
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+def load_events(path: str) -> list:
+    with open(path) as events_file:
+        return [json.loads(line) for line in events_file if line.strip()]
+
+def export_events(path: str, limit: int = None):
+    from tables import Local_Session, StripeEvents
+
+    db = Local_Session()
+    try:
+        query = db.query(StripeEvents.payload).order_by(StripeEvents.stripe_created)
+        if limit:
+            query = query.limit(limit)
+        count = 0
+        with open(path, "w") as events_file:
+            for (payload,) in query.yield_per(500):
+                events_file.write(json.dumps(payload) + "\n")
+                count += 1
+    finally:
+        db.close()
+    print(f"Exported {count} events to {path}")
+
+def replay_events(events: list, url: str, secret: str, rate: float, concurrency: int, repeat: int, fresh_ids: bool):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    statuses = Counter()
+    latencies = []
+    lock = threading.Lock()
+
+    def send(event: dict):
+        if fresh_ids:
+            event = {**event, "id": f"evt_replay_{uuid.uuid4().hex}"}
+        body = json.dumps(event, separators=(",", ":")).encode()
+        headers = {"Content-Type": "application/json", "Stripe-Signature": sign_payload(body, secret)}
+
+        started = time.perf_counter()
+        try:
+            status = session.post(url, data=body, headers=headers, timeout=30).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+
+        with lock:
+            statuses[status] += 1
+            latencies.append(elapsed)
+
+    stream = [event for _ in range(repeat) for event in events]
+    interval = 1 / rate if rate else 0
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index, event in enumerate(stream):
+            # Paced against the start time so slow sends do not lower the target rate
+            if interval:
+                delay = started + index * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(send, event)
+
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"Sent {len(stream)} events in {elapsed:.2f}s ({len(stream) / elapsed:.1f}/s)")
+    print(f"Responses: {dict(statuses)}")
+    if latencies:
+        print(f"Latency p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and replay Stripe webhook events")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Write stored Stripe_events payloads to a JSONL file")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--limit", type=int)
+
+    replay_parser = commands.add_parser("replay", help="POST events from a JSONL file to the webhook")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--url", default="http://localhost:8000/payment/webhook")
+    replay_parser.add_argument("--secret", default=os.getenv("STRIPE_WEBHOOK_SECRET1"))
+    replay_parser.add_argument("--rate", type=float, default=0, help="Events per second, 0 for as fast as possible")
+    replay_parser.add_argument("--concurrency", type=int, default=16)
+    replay_parser.add_argument("--repeat", type=int, default=1)
+    replay_parser.add_argument("--fresh-ids", action="store_true", help="Give every send a new event id instead of exercising dedupe")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export_events(args.path, args.limit)
+        return
+
+    if not args.secret:
+        sys.exit("Set STRIPE_WEBHOOK_SECRET1 or pass --secret")
+    replay_events(load_events(args.path), args.url, args.secret, args.rate, args.concurrency, args.repeat, args.fresh_ids)
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,12 @@ class StatusType(enum.Enum):
     shipped = "shipped"
     delivered = "delivered"
 
+class JobStatusType(str, enum.Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
 class DimensionType(str, enum.Enum):
     A3 = "A3"
     A4 = "A4"
@@ -62,6 +68,7 @@ class ProductsData (BaseModel):
     description: Optional[str] = None
     image_url: Optional[str] = None
     thumbnail_url: Optional[str] = None
+    variant_urls: Optional[dict[str, str]] = None
     image_file: Optional[str] = None
     thumbnail_file: Optional[str] = None
     price: float
@@ -244,4 +251,19 @@ class PicOfTheWeekResponse(BaseModel):
 
 class AdminCreate(BaseModel):
     username: str
-    password: str
\ No newline at end of file
+    password: str
+
+class ImageJobResponse(BaseModel):
+    id: int
+    kind: str
+    status: JobStatusType
+    attempts: int
+    max_attempts: int
+    error: Optional[str] = None
+    result: Optional[dict] = None
+    created_at: datetime
+    updated_at: datetime
+
+    model_config = {
+        "from_attributes": True
+    }
\ No newline at end of file
@@ -0,0 +1,117 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class ScratchStorage:
+    def __init__(self, directories: list, max_bytes: int, max_age_seconds: int, keep_originals: bool = False):
+        self.directories = directories
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.keep_originals = keep_originals
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        self._pinned = set()
+        self._foreign = set()
+        self.evictions = 0
+        self._scan()
+
+    def _scan(self):
+        # Files already on disk may belong to another process (the API and
+        # python jobs.py share these directories) whose queued jobs still need
+        # them. They count towards usage but are only removed once they are
+        # older than max_age_seconds, never to make room.
+        found = []
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.path, stat.st_size))
+
+        for mtime, path, size in sorted(found):
+            self._files[path] = (size, mtime)
+            self._foreign.add(path)
+        self.evict()
+
+    def register(self, path: str, size: int):
+        with self._lock:
+            self._files[path] = (size, time.time())
+            self._files.move_to_end(path)
+            self._pinned.add(path)
+            self._foreign.discard(path)
+        self.evict()
+
+    def hand_off(self, path: str):
+        # A queued job owns the file now. The worker that runs it registers it
+        # again, possibly in another process, so it is forgotten here but kept on disk.
+        with self._lock:
+            self._files.pop(path, None)
+            self._pinned.discard(path)
+
+    def touch(self, path: str):
+        with self._lock:
+            if path in self._files:
+                size, _ = self._files[path]
+                self._files[path] = (size, time.time())
+                self._files.move_to_end(path)
+
+    def release(self, path: str):
+        if not self.keep_originals:
+            self.discard(path)
+            return
+
+        with self._lock:
+            self._pinned.discard(path)
+        self.touch(path)
+        self.evict()
+
+    def discard(self, path: str):
+        with self._lock:
+            self._files.pop(path, None)
+            self._pinned.discard(path)
+            self._foreign.discard(path)
+        self._remove(path)
+
+    def evict(self):
+        expired_before = time.time() - self.max_age_seconds
+        evicted = []
+
+        with self._lock:
+            total = sum(size for size, _ in self._files.values())
+            for path, (size, last_used) in list(self._files.items()):
+                if path in self._pinned:
+                    continue
+                if last_used >= expired_before and (total <= self.max_bytes or path in self._foreign):
+                    continue
+                del self._files[path]
+                self._foreign.discard(path)
+                total -= size
+                evicted.append(path)
+            self.evictions += len(evicted)
+
+        for path in evicted:
+            self._remove(path)
+
+    def usage(self) -> dict:
+        with self._lock:
+            return {
+                "bytes": sum(size for size, _ in self._files.values()),
+                "max_bytes": self.max_bytes,
+                "files": len(self._files),
+                "pinned": len(self._pinned),
+                "evictions": self.evictions,
+                "keep_originals": self.keep_originals,
+            }
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove scratch file {path}: {e}")
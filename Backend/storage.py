@@ -0,0 +1,157 @@
+import os
+import re
+import uuid
+import shutil
+from abc import ABC, abstractmethod
+from urllib.parse import unquote, urlparse
+import cloudinary
+import cloudinary.api
+import cloudinary.uploader
+import cloudinary.utils
+
+class MediaStorage(ABC):
+    name = None
+
+    @abstractmethod
+    def upload(self, source, folder: str, public_id: str = None) -> str:
+        ...
+
+    @abstractmethod
+    def delete(self, public_id: str) -> bool:
+        ...
+
+    def delete_many(self, public_ids: list) -> dict:
+        deleted, failed = [], {}
+        for public_id in public_ids:
+            try:
+                if self.delete(public_id):
+                    deleted.append(public_id)
+                else:
+                    failed[public_id] = "not found"
+            except Exception as e:
+                failed[public_id] = str(e)
+        return {"deleted": deleted, "failed": failed}
+
+    @abstractmethod
+    def url(self, public_id: str) -> str:
+        ...
+
+    @abstractmethod
+    def public_id_from_url(self, url: str):
+        ...
+
+def default_public_id(source) -> str:
+    if isinstance(source, str):
+        return os.path.splitext(os.path.basename(source))[0]
+    return uuid.uuid4().hex
+
+class CloudinaryStorage(MediaStorage):
+    name = "cloudinary"
+    DELETE_BATCH_SIZE = 100
+
+    def __init__(self, cloud_name: str, api_key: str, api_secret: str):
+        cloudinary.config(cloud_name=cloud_name, api_key=api_key, api_secret=api_secret)
+
+    def upload(self, source, folder: str, public_id: str = None) -> str:
+        upload_result = cloudinary.uploader.upload(
+            source,
+            folder=folder,
+            public_id=public_id or default_public_id(source),
+            resource_type="image",
+            overwrite=True,
+        )
+        return upload_result["secure_url"]
+
+    def delete(self, public_id: str) -> bool:
+        result = cloudinary.uploader.destroy(public_id, resource_type="image")
+        return result.get("result") == "ok"
+
+    def delete_many(self, public_ids: list) -> dict:
+        deleted, failed = [], {}
+        # The Admin API takes at most 100 ids per call
+        for start in range(0, len(public_ids), self.DELETE_BATCH_SIZE):
+            batch = public_ids[start:start + self.DELETE_BATCH_SIZE]
+            try:
+                result = cloudinary.api.delete_resources(batch, resource_type="image")
+            except Exception as e:
+                failed.update({public_id: str(e) for public_id in batch})
+                continue
+
+            for public_id in batch:
+                status = result.get("deleted", {}).get(public_id)
+                if status == "deleted":
+                    deleted.append(public_id)
+                else:
+                    failed[public_id] = status or "unknown"
+        return {"deleted": deleted, "failed": failed}
+
+    def url(self, public_id: str) -> str:
+        url, _ = cloudinary.utils.cloudinary_url(public_id, resource_type="image", secure=True)
+        return url
+
+    def public_id_from_url(self, url: str):
+        # .../image/upload/v1760238039/uploads/fileid.jpg -> uploads/fileid
+        path = urlparse(url).path
+        if "/upload/" not in path:
+            return None
+        path = unquote(path.split("/upload/", 1)[1])
+        path = re.sub(r"^v\d+/", "", path)
+        return path.rsplit(".", 1)[0] or None
+
+class LocalStorage(MediaStorage):
+    name = "local"
+
+    def __init__(self, root: str, base_url: str):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+        self.mount_path = urlparse(self.base_url).path
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, public_id: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, public_id))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError(f"{public_id} is outside the media root")
+        return path
+
+    def upload(self, source, folder: str, public_id: str = None) -> str:
+        ext = os.path.splitext(source)[1] if isinstance(source, str) else ".jpg"
+        stored_id = f"{folder}/{public_id or default_public_id(source)}{ext or '.jpg'}"
+        path = self._path(stored_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if isinstance(source, str):
+            shutil.copyfile(source, path)
+        else:
+            with open(path, "wb") as out_file:
+                shutil.copyfileobj(source, out_file)
+        return self.url(stored_id)
+
+    def delete(self, public_id: str) -> bool:
+        try:
+            os.remove(self._path(public_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def url(self, public_id: str) -> str:
+        return f"{self.base_url}/{public_id}"
+
+    def public_id_from_url(self, url: str):
+        path = urlparse(url).path
+        if not path.startswith(f"{self.mount_path}/"):
+            return None
+        return unquote(path[len(self.mount_path) + 1:]) or None
+
+def build_media_storage(backend: str) -> MediaStorage:
+    if backend == "cloudinary":
+        return CloudinaryStorage(
+            cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME", "uiaphotography"),
+            api_key=os.getenv("CLOUDINARY_API_KEY"),
+            api_secret=os.getenv("CLOUDINARY_API_SECRET"),
+        )
+    if backend == "local":
+        return LocalStorage(
+            root=os.getenv("MEDIA_ROOT", "media"),
+            base_url=os.getenv("MEDIA_BASE_URL", "/media"),
+        )
+    raise ValueError(f"Unknown MEDIA_STORAGE backend: {backend}")
@@ -1,8 +1,9 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, Boolean, Numeric, Date, TIMESTAMP, func, DECIMAL, Enum, text
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Text, ForeignKey, Boolean, Numeric, Date, TIMESTAMP, func, DECIMAL, Enum, text, Computed, Index
+from sqlalchemy.dialects.postgresql import TSVECTOR, JSONB
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, deferred
 from datetime import datetime
-from schemas import ProductType, StatusType, DimensionType, PortfolioType
+from schemas import ProductType, StatusType, DimensionType, PortfolioType, JobStatusType
 import os
 from dotenv import load_dotenv
 
@@ -20,6 +21,11 @@ engine = create_engine(db_url)
 Local_Session = sessionmaker(bind=engine)
 Base = declarative_base()
 
+PRODUCT_SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+
 class Products(Base):
     __tablename__ = "Photos"
 
@@ -29,6 +35,7 @@ class Products(Base):
     description = Column(Text)
     image_url = Column(Text, nullable=True)
     thumbnail_url = Column(Text, nullable=True)
+    variant_urls = Column(JSONB, nullable=True)
     price = Column(Numeric(6, 2), nullable=False)
     is_for_sale = Column(Boolean, default=True)
     dimensions = Column(Enum(DimensionType, name="dimension_enum"), nullable=True)
@@ -37,9 +44,14 @@ class Products(Base):
     file_size_mb = Column(DECIMAL(5, 2),nullable=True)
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
     updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now())
+    search_vector = deferred(Column(TSVECTOR, Computed(PRODUCT_SEARCH_VECTOR, persisted=True), info={"internal": True}))
 
     items = relationship("OrderItem", back_populates="product")
 
+    __table_args__ = (
+        Index("ix_photos_search_vector", "search_vector", postgresql_using="gin"),
+    )
+
 class CheckoutInfo(Base):
     __tablename__ = "Checkout_Info"
 
@@ -76,6 +88,12 @@ class Orders(Base):
     checkout_info = relationship("CheckoutInfo", uselist=False, back_populates="order", cascade="all, delete", passive_deletes=True)
     shipping_info = relationship("ShippingInfo", uselist=False, back_populates="order", cascade="all, delete", passive_deletes=True)
 
+    __table_args__ = (
+        Index("ix_orders_status_id", "status", "id"),
+        Index("ix_orders_created_at_id", "created_at", "id"),
+        Index("ix_orders_customer_email_lower_id", func.lower(customer_email), id),
+    )
+
 class OrderItem(Base):
     __tablename__ = "OrderItems"
 
@@ -91,6 +109,10 @@ class OrderItem(Base):
     product = relationship("Products", foreign_keys=[product_id])
     checkout_info = relationship("CheckoutInfo", back_populates="items")
 
+    __table_args__ = (
+        Index("ix_order_items_order_id", "order_id"),
+    )
+
 class Shipping(Base):
     __tablename__ = "Shipping"
 
@@ -129,10 +151,15 @@ class Portfolio(Base):
     title = Column(String(255), nullable=False, unique=True)
     slug = Column(String(255), nullable=False, unique=True)
     category = Column(Enum(PortfolioType, name="portfolio_enum"), nullable=False)
+    is_published = Column(Boolean, nullable=False, default=True, server_default=text("true"))
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
 
     images = relationship("PortfolioImages", back_populates="portfolio", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index("ix_portfolio_category_created_at", "category", "created_at"),
+    )
+
 class PortfolioImages(Base):
     __tablename__ = "Portfolio_images"
     
@@ -153,6 +180,103 @@ class PicOfTheWeek(Base):
     image_url = Column(Text, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
 
+Index("ix_pic_of_the_week_created_at", PicOfTheWeek.created_at.desc())
+
+class MediaAssets(Base):
+    __tablename__ = "Media_assets"
+
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String(64), nullable=False)
+    kind = Column(String(30), nullable=False)
+    image_url = Column(Text, nullable=False, index=True)
+    thumbnail_url = Column(Text, nullable=True)
+    variant_urls = Column(JSONB, nullable=True)
+    size_bytes = Column(BigInteger, nullable=True)
+    ref_count = Column(Integer, nullable=False, default=1)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_media_assets_sha256_kind", "sha256", "kind", unique=True),
+    )
+
+class ImageJobs(Base):
+    __tablename__ = "Image_jobs"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(30), nullable=False)
+    status = Column(Enum(JobStatusType, name="job_status_enum"), nullable=False, default=JobStatusType.queued)
+    payload = Column(JSONB, nullable=False)
+    result = Column(JSONB, nullable=True)
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+    run_after = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ix_image_jobs_status_run_after", "status", "run_after"),
+    )
+
+class EmailOutbox(Base):
+    __tablename__ = "Email_outbox"
+
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey("Orders.id", ondelete="CASCADE"), nullable=False)
+    kind = Column(String(30), nullable=False)
+    dedupe_key = Column(String(100), nullable=False, unique=True)
+    status = Column(Enum(JobStatusType, name="job_status_enum"), nullable=False, default=JobStatusType.queued)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=6)
+    error = Column(Text, nullable=True)
+    provider_message_id = Column(String(100), nullable=True)
+    run_after = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    sent_at = Column(TIMESTAMP(timezone=True), nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ix_email_outbox_status_run_after", "status", "run_after"),
+    )
+
+class StripeEvents(Base):
+    __tablename__ = "Stripe_events"
+
+    id = Column(String(255), primary_key=True)
+    type = Column(String(100), nullable=False)
+    object_id = Column(String(255), nullable=True, index=True)
+    stripe_created = Column(BigInteger, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    status = Column(Enum(JobStatusType, name="job_status_enum"), nullable=False, default=JobStatusType.queued)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=8)
+    error = Column(Text, nullable=True)
+    run_after = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    received_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    processed_at = Column(TIMESTAMP(timezone=True), nullable=True)
+    updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ix_stripe_events_status_run_after", "status", "run_after"),
+        Index("ix_stripe_events_status_stripe_created", "status", "stripe_created"),
+    )
+
+class IdempotencyKeys(Base):
+    __tablename__ = "Idempotency_keys"
+
+    id = Column(Integer, primary_key=True)
+    scope = Column(String(50), nullable=False)
+    key = Column(String(255), nullable=False)
+    request_hash = Column(String(64), nullable=False)
+    status_code = Column(Integer, nullable=True)
+    response = Column(JSONB, nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False, index=True)
+
+    __table_args__ = (
+        Index("ix_idempotency_keys_scope_key", "scope", "key", unique=True),
+    )
+
 class Admin(Base):
     __tablename__ = "Admin"
 
@@ -163,6 +287,27 @@ class Admin(Base):
 
 Base.metadata.create_all(engine)
 
+# create_all only creates missing tables, so columns and indexes added to
+# existing tables are applied here. Every statement must be idempotent.
+SCHEMA_UPGRADES = [
+    f'ALTER TABLE "Photos" ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ({PRODUCT_SEARCH_VECTOR}) STORED',
+    'ALTER TABLE "Photos" ADD COLUMN IF NOT EXISTS variant_urls jsonb',
+    'ALTER TABLE "Media_assets" ADD COLUMN IF NOT EXISTS variant_urls jsonb',
+    'CREATE INDEX IF NOT EXISTS ix_photos_search_vector ON "Photos" USING gin (search_vector)',
+    'ALTER TABLE "Portfolio" ADD COLUMN IF NOT EXISTS is_published boolean NOT NULL DEFAULT true',
+    'CREATE INDEX IF NOT EXISTS ix_portfolio_category_created_at ON "Portfolio" (category, created_at)',
+    'CREATE INDEX IF NOT EXISTS ix_pic_of_the_week_created_at ON "Pic_of_the_week" (created_at DESC)',
+    'CREATE INDEX IF NOT EXISTS ix_orders_status_id ON "Orders" (status, id)',
+    'CREATE INDEX IF NOT EXISTS ix_orders_created_at_id ON "Orders" (created_at, id)',
+    'CREATE INDEX IF NOT EXISTS ix_orders_customer_email_lower_id ON "Orders" (lower(customer_email), id)',
+    'CREATE INDEX IF NOT EXISTS ix_order_items_order_id ON "OrderItems" (order_id)',
+    'CREATE INDEX IF NOT EXISTS ix_stripe_events_status_stripe_created ON "Stripe_events" (status, stripe_created)',
+]
+
+with engine.begin() as connection:
+    for statement in SCHEMA_UPGRADES:
+        connection.execute(text(statement))
+
 def get_db():
     db = Local_Session()
     try:
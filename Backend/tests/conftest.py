@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+import pytest
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The tests write and claim rows, so point PGDB at a scratch database.
+# Media goes to a temp dir and no background workers are started.
+os.environ.setdefault("MEDIA_STORAGE", "local")
+os.environ.setdefault("MEDIA_ROOT", tempfile.mkdtemp(prefix="media-"))
+for workers in ("IMAGE_JOB_WORKERS", "EMAIL_WORKERS", "STRIPE_EVENT_WORKERS"):
+    os.environ.setdefault(workers, "0")
+
+@pytest.fixture(scope="session")
+def engine():
+    # tables.py builds the URL from these at import, and a missing port fails to parse
+    load_dotenv()
+    missing = [name for name in ("PGUSER", "PGPASSWORD", "PGDB", "PGHOST", "PGPORT") if not os.getenv(name)]
+    if missing:
+        pytest.skip(f"Postgres is not configured, set {', '.join(missing)}")
+
+    try:
+        import tables
+    except OperationalError as e:
+        pytest.skip(f"Postgres is not reachable: {e}")
+    return tables.engine
+
+@pytest.fixture
+def db(engine):
+    from tables import Local_Session
+
+    session = Local_Session()
+    try:
+        yield session
+    finally:
+        session.close()
+
+@pytest.fixture
+def statements(engine):
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield executed
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
@@ -0,0 +1,99 @@
+import io
+import time
+import uuid
+import asyncio
+import threading
+from collections import Counter
+import httpx
+import pytest
+from PIL import Image
+
+@pytest.fixture
+def queued_jobs(db):
+    from tables import ImageJobs
+    from schemas import JobStatusType
+
+    marker = uuid.uuid4().hex
+    jobs = [ImageJobs(kind="test", payload={"marker": marker, "index": index}, status=JobStatusType.queued) for index in range(40)]
+    db.add_all(jobs)
+    db.commit()
+    job_ids = [job.id for job in jobs]
+
+    yield job_ids
+
+    db.query(ImageJobs).filter(ImageJobs.id.in_(job_ids)).delete(synchronize_session=False)
+    db.commit()
+
+def test_two_workers_claim_each_job_once(engine, queued_jobs):
+    from tables import Local_Session, ImageJobs
+    from jobs import claim_next
+
+    claimed = {0: [], 1: []}
+    start = threading.Barrier(2)
+
+    def worker(number: int):
+        session = Local_Session()
+        try:
+            start.wait()
+            while True:
+                job = claim_next(session, ImageJobs, timeout_seconds=3600)
+                if not job:
+                    return
+                claimed[number].append(job.id)
+                # Hold on to the job for a moment, like a real worker would
+                time.sleep(0.005)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in claimed]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+
+    counts = Counter(claimed[0] + claimed[1])
+    assert all(count == 1 for count in counts.values())
+    assert set(queued_jobs) <= set(counts)
+    assert claimed[0] and claimed[1]
+
+def test_storefront_stays_responsive_during_upload(engine, monkeypatch):
+    import func
+    from main import app
+
+    upload_original = func.upload_original
+
+    def slow_upload(local_path, folder="uploads", public_id=None):
+        time.sleep(1.5)
+        return upload_original(local_path, folder, public_id)
+
+    monkeypatch.setattr(func, "upload_original", slow_upload)
+
+    image = io.BytesIO()
+    Image.new("RGB", (2400, 1600), (120, 80, 40)).save(image, "JPEG")
+    title = f"concurrency-{uuid.uuid4().hex[:12]}"
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            upload = asyncio.create_task(client.post(
+                "/products/add-photos-file",
+                data={"title": title, "price": "10"},
+                files={"image_file": ("concurrency.jpg", image.getvalue(), "image/jpeg")},
+            ))
+
+            latencies = []
+            while not upload.done():
+                started = time.perf_counter()
+                await client.get("/products/view-photos-table")
+                latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(0.05)
+
+            response = await upload
+            await client.delete(f"/products/delete-a-photo/{title}", params={"product_title": title})
+            return response, latencies
+
+    response, latencies = asyncio.run(scenario())
+
+    assert response.status_code == 200
+    assert len(latencies) >= 5
+    assert max(latencies) < 0.5
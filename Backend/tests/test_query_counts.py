@@ -0,0 +1,110 @@
+import uuid
+import asyncio
+import pytest
+from schemas import PortfolioType
+
+@pytest.fixture
+def make_portfolios(db):
+    from tables import Portfolio, PortfolioImages
+
+    created = []
+
+    def make(count: int, images_each: int = 3):
+        for _ in range(count):
+            name = f"query-count-{uuid.uuid4().hex[:12]}"
+            portfolio = Portfolio(title=name, slug=name, category=PortfolioType.editorial)
+            db.add(portfolio)
+            db.flush()
+            db.add_all(
+                PortfolioImages(portfolio_id=portfolio.id, image_url=f"/media/{name}/{index}.jpg", thumbnail_url=f"/media/{name}/{index}_grid.jpg")
+                for index in range(images_each)
+            )
+            created.append(portfolio.id)
+        db.commit()
+
+    yield make
+
+    db.rollback()
+    db.query(PortfolioImages).filter(PortfolioImages.portfolio_id.in_(created)).delete(synchronize_session=False)
+    db.query(Portfolio).filter(Portfolio.id.in_(created)).delete(synchronize_session=False)
+    db.commit()
+
+@pytest.fixture
+def make_products(db):
+    from tables import Products
+
+    created = []
+
+    def make(count: int) -> list:
+        for _ in range(count):
+            name = f"query-count-{uuid.uuid4().hex[:12]}"
+            product = Products(title=name, slug=name, price=10, is_for_sale=True)
+            db.add(product)
+            db.flush()
+            created.append((product.id, product.slug))
+        db.commit()
+        return created[-count:]
+
+    yield make
+
+    db.rollback()
+    db.query(Products).filter(Products.id.in_([product_id for product_id, _ in created])).delete(synchronize_session=False)
+    db.commit()
+
+def test_portfolio_listing_query_count_does_not_grow(db, statements, make_portfolios):
+    from products import load_portfolios
+
+    make_portfolios(1)
+    db.expire_all()
+    statements.clear()
+    load_portfolios(db)
+    few = len(statements)
+
+    make_portfolios(10)
+    db.expire_all()
+    statements.clear()
+    load_portfolios(db)
+
+    assert len(statements) == few
+
+def test_portfolio_listing_is_served_from_cache(db, statements, make_portfolios):
+    from cache import portfolio_cache, invalidate_portfolios
+    from products import load_portfolios
+
+    make_portfolios(2)
+    invalidate_portfolios()
+    portfolio_cache.get(lambda: load_portfolios(db))
+
+    statements.clear()
+    portfolio_cache.get(lambda: load_portfolios(db))
+    assert statements == []
+
+def test_batch_lookup_is_one_query(db, statements, make_products):
+    from func import get_products_by_ids
+
+    product_ids = [product_id for product_id, _ in make_products(20)]
+
+    statements.clear()
+    get_products_by_ids(db, product_ids[:1])
+    single = len(statements)
+
+    statements.clear()
+    found = get_products_by_ids(db, product_ids)
+
+    assert len(statements) == single == 1
+    assert set(found) == set(product_ids)
+
+def test_by_slug_lookup_is_cached(db, statements, make_products):
+    from cache import invalidate_products
+    from products import view_product_by_slug
+
+    _, slug = make_products(1)[0]
+    invalidate_products(slug)
+
+    statements.clear()
+    asyncio.run(view_product_by_slug(slug, db))
+    assert len(statements) == 1
+
+    statements.clear()
+    asyncio.run(view_product_by_slug(slug, db))
+    assert statements == []
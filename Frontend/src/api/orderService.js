@@ -39,8 +39,20 @@ export const orderService = {
     return apiClient.post(`/order?shipping_type=${shippingType}`, orderData);
   },
   
-  // Get all orders
-  getAllOrders: () => apiClient.get('/view-orders'),
+  // Get one page of orders, filters: status, created_from, created_to, customer_email
+  getOrdersPage: (params = {}) => apiClient.get('/view-orders', { params }),
+
+  // Get all orders, following X-Next-Cursor one page at a time
+  getAllOrders: async (params = {}) => {
+    const orders = [];
+    let cursor;
+    do {
+      const response = await orderService.getOrdersPage({ ...params, cursor });
+      orders.push(...response.data);
+      cursor = response.headers['x-next-cursor'];
+    } while (cursor);
+    return { data: orders };
+  },
   
   // Delete an order (admin) - using path parameter instead of query parameter
   deleteOrder: (orderId) => apiClient.delete(`/delete-an-order`, {